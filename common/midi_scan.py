@@ -0,0 +1,316 @@
+import os
+import struct
+import hashlib
+import pretty_midi
+
+# Define min length in seconds for a midi file
+MIN_LENGTH=15
+
+# Largest tick pretty_midi accepts before it considers a midi file corrupt
+MAX_TICK = 1e7
+
+# Largest meta/sysex length mido accepts
+MAX_MESSAGE_LENGTH = 1000000
+
+# Number of data bytes of each channel message type
+CHANNEL_DATA_LENGTH = {0x80: 2, 0x90: 2, 0xa0: 2, 0xb0: 2, 0xc0: 1, 0xd0: 1, 0xe0: 2}
+
+# Meta types mido knows, it drops the delta time of any other meta message
+META_TYPES = {0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x09, 0x20, 0x21, 0x2f, 0x51, 0x54, 0x58, 0x59, 0x7f}
+
+# Shortest data mido can decode for these meta messages, by meta type
+META_DATA_LENGTH = {0x20: 1, 0x51: 3, 0x54: 5, 0x58: 4, 0x59: 2}
+
+class MidiScanError(Exception):
+    # The file would fail to load with pretty_midi as well
+    pass
+
+class MidiScanUnsupported(Exception):
+    # The scanner can't decide this file, it needs a full parse
+    pass
+
+def read_variable_int(data, pos):
+    value = 0
+    while True:
+        if pos >= len(data):
+            raise MidiScanError("Unexpected end of file.")
+
+        byte = data[pos]
+        pos += 1
+
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, pos
+
+def tick_to_time(tick, tick_scales):
+    # Same piecewise computation pretty_midi uses to fill its tick to time array
+    last_end_time = 0
+    for (start_tick, tick_scale), (end_tick, _) in zip(tick_scales[:-1], tick_scales[1:]):
+        if tick <= end_tick:
+            return last_end_time + tick_scale * (tick - start_tick)
+        last_end_time = last_end_time + tick_scale * (end_tick - start_tick)
+
+    start_tick, tick_scale = tick_scales[-1]
+    return last_end_time + tick_scale * (tick - start_tick)
+
+def scan_midi(midi_path):
+    with open(midi_path, "rb") as fp:
+        data = fp.read()
+
+    return scan_midi_bytes(data)
+
+def scan_midi_bytes(data):
+    # Read the instrument programs and end time pretty_midi would find in a midi file,
+    # walking the raw events without building any message or note objects.
+    if len(data) < 8:
+        raise MidiScanError("Unexpected end of file.")
+
+    name, size = struct.unpack(">4sL", data[:8])
+    if name != b"MThd":
+        raise MidiScanError("MThd not found.")
+    if size < 6 or len(data) < 14:
+        raise MidiScanError("Unexpected end of file.")
+
+    midi_type, num_tracks, resolution = struct.unpack(">hhh", data[8:14])
+    if resolution <= 0:
+        raise MidiScanUnsupported("SMPTE or zero time division.")
+    if num_tracks <= 0:
+        raise MidiScanError("Midi file has no tracks.")
+
+    tempo_changes = []
+    max_tick = 0
+    end_tick = 0
+
+    # Instruments keyed by (program, channel, track) with [last note end tick, cc/bend box].
+    # Boxes hold the last tick of control changes and pitch bends. Like pretty_midi's
+    # "straggler" lists, a box created before the first note is shared with the instruments
+    # later created on the same channel and track.
+    instruments = {}
+    stragglers = {}
+
+    pos = 8 + size
+    for track_ix in range(num_tracks):
+        if pos + 8 > len(data):
+            raise MidiScanError("Unexpected end of file.")
+
+        name, size = struct.unpack(">4sL", data[pos:pos + 8])
+        if name != b"MTrk":
+            raise MidiScanError("No MTrk header at start of track.")
+
+        pos += 8
+        start = pos
+
+        tick = 0
+        n_events = 0
+        last_status = None
+        programs = [0] * 16
+        last_note_on = {}
+
+        while pos - start != size:
+            delta, pos = read_variable_int(data, pos)
+            tick += delta
+            n_events += 1
+
+            if pos >= len(data):
+                raise MidiScanError("Unexpected end of file.")
+            status = data[pos]
+            pos += 1
+
+            running_status = status < 0x80
+            if running_status:
+                if last_status is None:
+                    raise MidiScanError("Running status without last status.")
+                pos -= 1
+                status = last_status
+            elif status != 0xff:
+                last_status = status
+
+            if status == 0xff:
+                if pos >= len(data):
+                    raise MidiScanError("Unexpected end of file.")
+                meta_type = data[pos]
+                length, pos = read_variable_int(data, pos + 1)
+                if length > MAX_MESSAGE_LENGTH:
+                    raise MidiScanError("Message length exceeds maximum length.")
+                if pos + length > len(data):
+                    raise MidiScanError("Unexpected end of file.")
+                meta = data[pos:pos + length]
+                pos += length
+
+                if meta_type not in META_TYPES:
+                    tick -= delta
+
+                # Leave anything mido or pretty_midi might fail to decode to the full parse
+                if length < META_DATA_LENGTH.get(meta_type, 0) or (meta_type == 0x00 and length == 1):
+                    raise MidiScanUnsupported("Malformed meta message.")
+                if meta_type == 0x59 and not (-7 <= struct.unpack("b", meta[:1])[0] <= 7 and meta[1] in (0, 1)):
+                    raise MidiScanUnsupported("Invalid key signature.")
+                if meta_type == 0x54 and meta[0] >> 5 > 3:
+                    raise MidiScanUnsupported("Invalid SMPTE frame rate.")
+
+                if meta_type in (0x01, 0x05):
+                    # Text and lyrics on any track count for the end time
+                    end_tick = max(end_tick, tick)
+                elif track_ix == 0 and meta_type == 0x51:
+                    tempo_changes.append((tick, (meta[0] << 16) | (meta[1] << 8) | meta[2]))
+                elif track_ix == 0 and meta_type in (0x58, 0x59):
+                    # Time and key signatures on the first track count for the end time
+                    if meta_type == 0x58 and meta[0] == 0:
+                        raise MidiScanUnsupported("Time signature with zero numerator.")
+                    end_tick = max(end_tick, tick)
+
+            elif status == 0xf0 or status == 0xf7:
+                if running_status:
+                    raise MidiScanUnsupported("Running status on sysex.")
+                length, pos = read_variable_int(data, pos)
+                if length > MAX_MESSAGE_LENGTH:
+                    raise MidiScanError("Message length exceeds maximum length.")
+                if pos + length > len(data):
+                    raise MidiScanError("Unexpected end of file.")
+                pos += length
+
+            elif status >= 0xf0:
+                raise MidiScanUnsupported("System message in midi file.")
+
+            else:
+                message_type = status & 0xf0
+                channel = status & 0x0f
+
+                length = CHANNEL_DATA_LENGTH[message_type]
+                if pos + length > len(data):
+                    raise MidiScanError("Unexpected end of file.")
+                if data[pos] > 127 or (length == 2 and data[pos + 1] > 127):
+                    raise MidiScanError("Data byte must be in range 0..127.")
+
+                if message_type == 0xc0:
+                    programs[channel] = data[pos]
+
+                elif message_type == 0x90 and data[pos + 1] > 0:
+                    key = (channel, data[pos])
+                    if key not in last_note_on:
+                        last_note_on[key] = []
+                    last_note_on[key].append(tick)
+
+                elif message_type == 0x80 or message_type == 0x90:
+                    # A note off closes every open note of its pitch that didn't start on this tick
+                    key = (channel, data[pos])
+                    if key in last_note_on:
+                        open_notes = last_note_on[key]
+                        notes_to_keep = [t for t in open_notes if t == tick]
+
+                        if len(notes_to_keep) < len(open_notes):
+                            instrument_key = (programs[channel], channel, track_ix)
+                            if instrument_key not in instruments:
+                                box = stragglers.get((channel, track_ix), [0, False])
+                                instruments[instrument_key] = [tick, box]
+                            instruments[instrument_key][0] = max(instruments[instrument_key][0], tick)
+
+                        if len(notes_to_keep) < len(open_notes) and len(notes_to_keep) > 0:
+                            last_note_on[key] = notes_to_keep
+                        else:
+                            del last_note_on[key]
+
+                elif message_type == 0xb0 or message_type == 0xe0:
+                    instrument_key = (programs[channel], channel, track_ix)
+                    if instrument_key in instruments:
+                        box = instruments[instrument_key][1]
+                    elif (channel, track_ix) in stragglers:
+                        box = stragglers[(channel, track_ix)]
+                    else:
+                        box = [0, False]
+                        stragglers[(channel, track_ix)] = box
+
+                    box[0] = max(box[0], tick)
+                    box[1] = True
+
+                pos += length
+
+        if n_events == 0:
+            raise MidiScanError("Midi track has no events.")
+
+        max_tick = max(max_tick, tick)
+
+    if max_tick + 1 > MAX_TICK:
+        raise MidiScanError("Midi file has a largest tick of " + str(max_tick + 1) + ", it is likely corrupt.")
+
+    # Tempo map, as pretty_midi reads it from the first track
+    tick_scales = [(0, 60.0/(120.0*resolution))]
+    for tick, tempo in tempo_changes:
+        if tempo == 0:
+            raise MidiScanUnsupported("Zero tempo.")
+
+        if tick == 0:
+            bpm = 6e7/tempo
+            tick_scales = [(0, 60.0/(bpm*resolution))]
+        else:
+            _, last_tick_scale = tick_scales[-1]
+            tick_scale = 60.0/((6e7/tempo)*resolution)
+            if tick_scale != last_tick_scale:
+                tick_scales.append((tick, tick_scale))
+
+    # End of the last note, control change or pitch bend of every instrument
+    for note_end_tick, box in instruments.values():
+        end_tick = max(end_tick, note_end_tick)
+        if box[1]:
+            end_tick = max(end_tick, box[0])
+
+    # Tempo changes count for the end time too
+    end_tick = max(end_tick, tick_scales[-1][0])
+
+    programs = [program for program, channel, track_ix in instruments]
+    return programs, tick_to_time(end_tick, tick_scales)
+
+def read_midi_info(midi_path):
+    # Scan raw events for the instrument programs and length, without building notes
+    try:
+        return scan_midi(midi_path)
+    except MidiScanUnsupported:
+        pass
+
+    # Fall back to a full parse for files the scanner can't decide
+    midi_data = pretty_midi.PrettyMIDI(midi_path)
+    return [inst.program for inst in midi_data.instruments], midi_data.get_end_time()
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+def validate_midi(midi_path, entry=None):
+    # Reuse the manifest verdict if the file didn't change since it was cleaned
+    stat = os.stat(midi_path)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        return entry
+
+    md5 = file_md5(midi_path)
+    if entry is not None and entry["md5"] == md5:
+        return dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns)
+
+    entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "md5": md5, "length": 0}
+
+    try:
+        # Get midi programs and length in seconds
+        midi_programs, midi_length = read_midi_info(midi_path)
+    except:
+        entry["verdict"] = "corrupt"
+        return entry
+
+    # Check midi file has only piano tracks
+    non_piano_instruments = 0
+    for program in midi_programs:
+        # Only consider instruments from the piano family
+        if pretty_midi.program_to_instrument_class(program) != "Piano":
+            non_piano_instruments += 1
+
+    entry["length"] = midi_length
+    if non_piano_instruments > 0:
+        entry["verdict"] = "non_piano"
+    elif midi_length <= MIN_LENGTH:
+        entry["verdict"] = "too_short"
+    else:
+        entry["verdict"] = "ok"
+
+    return entry
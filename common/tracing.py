@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import contextlib
+import collections
+
+# Dir every process appends its trace events to. Tracing is off while it is None.
+TRACE_DIR = None
+
+# Events and counters of this process not flushed yet, and the depth of the open spans
+EVENTS = []
+COUNTERS = collections.Counter()
+DEPTH = 0
+
+# Shared by every span while tracing is off, so disabled spans cost one call
+NULL_SPAN = contextlib.nullcontext()
+
+# Number of pieces in the slowest pieces table
+SLOWEST_PIECES = 10
+
+def enable_tracing(trace_dir):
+    # Also used as executor initializer, so workers trace to the same dir. Forked
+    # workers drop what they inherited from the parent, the parent flushes it itself.
+    global TRACE_DIR, EVENTS, COUNTERS
+    TRACE_DIR = trace_dir
+    EVENTS = []
+    COUNTERS = collections.Counter()
+
+def start_tracing():
+    trace_dir = tempfile.mkdtemp(prefix="vgmidi_trace_")
+    enable_tracing(trace_dir)
+    return trace_dir
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        rss *= 1024
+    return rss
+
+class Span:
+    def __init__(self, name, piece):
+        self.name = name
+        self.piece = piece
+
+    def __enter__(self):
+        global DEPTH
+        DEPTH += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global DEPTH
+        end = time.perf_counter()
+        DEPTH -= 1
+
+        EVENTS.append({"name": self.name, "piece": self.piece, "start": self.start, "duration": end - self.start, "pid": os.getpid(), "depth": DEPTH})
+
+        # Outermost spans are the unit of work of a worker, so flush them as they close
+        if DEPTH == 0:
+            flush_trace()
+
+def span(name, piece=None):
+    if TRACE_DIR is None:
+        return NULL_SPAN
+    return Span(name, piece)
+
+def count(name, n=1):
+    if TRACE_DIR is not None:
+        COUNTERS[name] += n
+
+def flush_trace():
+    global EVENTS, COUNTERS
+    if TRACE_DIR is None:
+        return
+
+    # One file per process, so workers never write to the same file
+    with open(os.path.join(TRACE_DIR, str(os.getpid()) + ".jsonl"), "a") as fp:
+        for event in EVENTS:
+            fp.write(json.dumps(event) + "\n")
+        fp.write(json.dumps({"pid": os.getpid(), "counters": COUNTERS, "rss": peak_rss()}) + "\n")
+
+    EVENTS = []
+    COUNTERS = collections.Counter()
+
+def collect_trace(trace_dir):
+    # Merge the files of every process. Returns the events, summed counters and peak rss per process.
+    flush_trace()
+
+    events, counters, rss = [], collections.Counter(), {}
+    for filename in os.listdir(trace_dir):
+        with open(os.path.join(trace_dir, filename), "r") as fp:
+            for line in fp:
+                record = json.loads(line)
+                if "counters" in record:
+                    counters.update(record["counters"])
+                    rss[record["pid"]] = max(rss.get(record["pid"], 0), record["rss"])
+                else:
+                    events.append(record)
+
+    return events, counters, rss
+
+def stop_tracing(trace_dir):
+    events, counters, rss = collect_trace(trace_dir)
+
+    enable_tracing(None)
+    shutil.rmtree(trace_dir, ignore_errors=True)
+
+    return events, counters, rss
+
+def write_chrome_trace(events, rss, trace_path):
+    # Trace Event Format, for chrome://tracing and Perfetto. Timestamps are in microseconds
+    # since the first event, perf_counter being the same monotonic clock in every process.
+    origin = min([e["start"] for e in events], default=0)
+
+    trace_events = []
+    for e in events:
+        trace_events.append({"name": e["name"], "cat": "stage", "ph": "X", "pid": e["pid"], "tid": e["pid"],
+                               "ts": (e["start"] - origin) * 1e6, "dur": e["duration"] * 1e6, "args": {"piece": e["piece"]}})
+
+    end = max([(e["start"] + e["duration"] - origin) * 1e6 for e in events], default=0)
+    for pid, peak in rss.items():
+        trace_events.append({"name": "peak_rss", "ph": "C", "pid": pid, "ts": end, "args": {"MB": peak/2**20}})
+
+    with open(trace_path, "w") as fp:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, fp)
+
+def print_trace_summary(events, counters, rss, stages, unit="piece", top=SLOWEST_PIECES):
+    # Time of the given stages per piece, slowest pieces first, then totals of every stage
+    times = collections.defaultdict(collections.Counter)
+    for e in events:
+        if e["piece"] is not None:
+            times[e["piece"]][e["name"]] += e["duration"]
+
+    slowest = sorted(times.items(), key=lambda t: -sum(t[1][s] for s in stages))[:top]
+
+    print("Slowest {}s (in seconds):".format(unit))
+    print("{:40s} {:>8s}".format(unit, "total") + "".join(" {:>8s}".format(s[:8]) for s in stages))
+    for piece, piece_times in slowest:
+        print("{:40s} {:8.3f}".format(str(piece)[:40], sum(piece_times[s] for s in stages)) + "".join(" {:8.3f}".format(piece_times[s]) for s in stages))
+
+    stage_times = collections.Counter()
+    stage_calls = collections.Counter()
+    for e in events:
+        stage_times[e["name"]] += e["duration"]
+        stage_calls[e["name"]] += 1
+
+    print("Stages (in seconds, summed over processes):")
+    for name, total in stage_times.most_common():
+        print("{:40s} {:8.3f} {:8d} calls".format(name, total, stage_calls[name]))
+
+    print("Counts:")
+    for name, n in sorted(counters.items()):
+        print("{:40s} {:8d}".format(name, n))
+
+    main_rss = rss.get(os.getpid(), peak_rss())
+    worker_rss = [r for pid, r in rss.items() if pid != os.getpid()]
+    print("Peak RSS (MB): main {:.1f}, workers {:.1f}".format(main_rss/2**20, max(worker_rss, default=0)/2**20))
@@ -0,0 +1,136 @@
+import io
+import os
+import json
+import mmap
+import zlib
+import struct
+import zipfile
+import hashlib
+import pretty_midi
+
+# Dir of the phrases inside phrases.zip
+PHRASES_DIR = "phrases"
+
+# Dir of the central directory indexes of the zips read so far, kept out of the dataset dir
+INDEX_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "vgmidi")
+
+# Local file header: signature, versions, flags, method, time, date, crc, sizes, name and extra lengths
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+
+def write_phrases_zip(zip_path, phrase_files):
+    write_sorted_phrases_zip(zip_path, sorted(phrase_files))
+
+def write_phrases_zip_dir(zip_path, phrases_dir):
+    # Same as write_phrases_zip for the phrases of a dir, reading one phrase at a time
+    def read_phrase(phrase_path):
+        with open(phrase_path, "rb") as fp:
+            return fp.read()
+
+    phrase_paths = sorted(os.path.join(phrases_dir, f) for f in os.listdir(phrases_dir))
+    write_sorted_phrases_zip(zip_path, ((phrase_path, read_phrase(phrase_path)) for phrase_path in phrase_paths))
+
+def write_sorted_phrases_zip(zip_path, phrase_files):
+    # Phrases are stored uncompressed, so readers can map them without extracting or inflating.
+    # Timestamps are fixed and phrases sorted so rebuilding the same phrases gives the same zip.
+    tmp_path = zip_path + ".tmp"
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED) as zf:
+        for phrase_path, phrase_bytes in phrase_files:
+            info = zipfile.ZipInfo(PHRASES_DIR + "/" + os.path.basename(phrase_path), date_time=(1980, 1, 1, 0, 0, 0))
+            zf.writestr(info, phrase_bytes)
+
+    os.replace(tmp_path, zip_path)
+
+def index_cache_path(zip_path):
+    # One index per zip path, since the index is only valid for this machine's copy of it
+    key = hashlib.md5(os.path.realpath(zip_path).encode("utf-8")).hexdigest()
+    return os.path.join(INDEX_CACHE, key + ".index.json")
+
+class PhraseArchive:
+    def __init__(self, zip_path, index_path=None):
+        self.zip_path = zip_path
+        self.index_path = index_path
+        if self.index_path is None:
+            self.index_path = index_cache_path(zip_path)
+
+        with open(zip_path, "rb") as fp:
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+
+        self.index = self.load_index()
+
+        # Csv paths point at the extracted phrases dir, so members are resolved by file name
+        self.members = {os.path.basename(name): name for name in self.index}
+
+    def load_index(self):
+        # Reuse the central directory index of a previous run if the zip didn't change
+        stat = os.stat(self.zip_path)
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, "r") as fp:
+                    index = json.load(fp)
+                if index["size"] == stat.st_size and index["mtime"] == stat.st_mtime_ns:
+                    return index["members"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        members = {}
+        with zipfile.ZipFile(self.zip_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or info.filename.startswith("__MACOSX/"):
+                    continue
+
+                # Data starts after the local header, whose extra field may differ from the central one
+                header = LOCAL_HEADER.unpack_from(self.mmap, info.header_offset)
+                data_offset = info.header_offset + LOCAL_HEADER.size + header[10] + header[11]
+
+                members[info.filename] = [data_offset, info.compress_type, info.compress_size, info.file_size, info.CRC, info.flag_bits]
+
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(self.index_path, "w") as fp:
+                json.dump({"size": stat.st_size, "mtime": stat.st_mtime_ns, "members": members}, fp)
+        except OSError:
+            # Unwritable cache dir, the index is just rebuilt next time
+            pass
+
+        return members
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, midi_path):
+        return os.path.basename(midi_path) in self.members
+
+    def resolve(self, midi_path):
+        return self.members[os.path.basename(midi_path)]
+
+    def read(self, midi_path):
+        name = self.resolve(midi_path)
+        data_offset, compress_type, compress_size, file_size, crc, flag_bits = self.index[name]
+
+        # Encrypted members are left to zipfile
+        if flag_bits & 0x1:
+            with zipfile.ZipFile(self.zip_path) as zf:
+                return zf.read(name)
+
+        data = self.view[data_offset:data_offset + compress_size]
+        if compress_type == zipfile.ZIP_STORED:
+            # Zero-copy view into the mapped zip
+            pass
+        elif compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        else:
+            with zipfile.ZipFile(self.zip_path) as zf:
+                return zf.read(name)
+
+        if zlib.crc32(data) != crc:
+            raise zipfile.BadZipFile("Bad CRC-32 for file " + name)
+
+        return data
+
+    def read_midi(self, midi_path):
+        return pretty_midi.PrettyMIDI(io.BytesIO(self.read(midi_path)))
+
+    def close(self):
+        self.view.release()
+        self.mmap.close()
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+import pretty_midi
+import numpy as np
+
+from parse     import parse_annotation, parse_emotion_dimension
+from split     import split_annotation_by_emotion, slice_midi, split_midi
+from cluster   import cluster_annotations
+from synthetic import generate_corpus
+
+# Modules shared with the unlabelled scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+from midi_scan import validate_midi
+
+# Corpus sizes: number of pieces, annotators per piece, measures per piece and notes per measure
+SCALES = {"small": {"pieces": 20, "annotators": 10, "measures": 16, "notes": 8},
+         "medium": {"pieces": 100, "annotators": 30, "measures": 32, "notes": 16},
+          "large": {"pieces": 400, "annotators": 30, "measures": 64, "notes": 16}}
+
+# Fast stages are rerun until they took at least this many seconds, so their best time is stable
+MIN_STAGE_TIME = 0.5
+
+# Max relative throughput drop against the baseline before a stage counts as a regression
+TOLERANCE = 0.2
+
+def prepare_inputs(annotations_path, midi_path):
+    # Inputs of every stage, computed once outside the timed runs
+    inputs = {"annotations": annotations_path, "midi": midi_path}
+
+    inputs["pieces"] = parse_annotation(annotations_path)
+    inputs["dimensions"] = [(parse_emotion_dimension(piece, "valence"), parse_emotion_dimension(piece, "arousal")) for piece in inputs["pieces"].values()]
+
+    inputs["medians"] = []
+    for valence_data, arousal_data in inputs["dimensions"]:
+        valence_clustering, valence_best_cluster = cluster_annotations(valence_data)
+        arousal_clustering, arousal_best_cluster = cluster_annotations(arousal_data)
+        inputs["medians"].append((np.mean(valence_clustering[valence_best_cluster], axis=0), np.mean(arousal_clustering[arousal_best_cluster], axis=0)))
+
+    inputs["chunks"] = [split_annotation_by_emotion(valence, arousal) for valence, arousal in inputs["medians"]]
+
+    midi_names = [os.path.basename(piece["midi"]) for piece in inputs["pieces"].values()]
+    inputs["midi_paths"] = [os.path.join(midi_path, name) for name in midi_names]
+    inputs["midi_data"] = [pretty_midi.PrettyMIDI(path) for path in inputs["midi_paths"]]
+
+    return inputs
+
+# Stages run one hot path over the whole corpus and return the number of items processed
+
+def stage_parse_annotation(inputs, tmp_path):
+    return len(parse_annotation(inputs["annotations"]))
+
+def stage_parse_emotion_dimension(inputs, tmp_path):
+    for piece in inputs["pieces"].values():
+        parse_emotion_dimension(piece, "valence")
+        parse_emotion_dimension(piece, "arousal")
+    return len(inputs["pieces"])
+
+def stage_cluster_annotations(inputs, tmp_path):
+    for valence_data, arousal_data in inputs["dimensions"]:
+        cluster_annotations(valence_data)
+        cluster_annotations(arousal_data)
+    return len(inputs["dimensions"])
+
+def stage_split_annotation_by_emotion(inputs, tmp_path):
+    for valence, arousal in inputs["medians"]:
+        split_annotation_by_emotion(valence, arousal)
+    return len(inputs["medians"])
+
+def stage_slice_midi(inputs, tmp_path):
+    # One slice per measure
+    n_slices = 0
+    for piece, midi_data in zip(inputs["pieces"].values(), inputs["midi_data"]):
+        measure_length = piece["duration"]/piece["measures"]
+        for m in range(piece["measures"]):
+            slice_midi(midi_data, m * measure_length, (m + 1) * measure_length)
+        n_slices += piece["measures"]
+    return n_slices
+
+def stage_split_midi(inputs, tmp_path):
+    for (piece_id, piece), midi_path, chunks in zip(inputs["pieces"].items(), inputs["midi_paths"], inputs["chunks"]):
+        split_midi(piece_id, midi_path, chunks, piece["duration"]/piece["measures"], tmp_path)
+    return len(inputs["midi_paths"])
+
+def stage_validate_midi(inputs, tmp_path):
+    for midi_path in inputs["midi_paths"]:
+        validate_midi(midi_path)
+    return len(inputs["midi_paths"])
+
+STAGES = {"parse_annotation": stage_parse_annotation,
+   "parse_emotion_dimension": stage_parse_emotion_dimension,
+       "cluster_annotations": stage_cluster_annotations,
+"split_annotation_by_emotion": stage_split_annotation_by_emotion,
+                "slice_midi": stage_slice_midi,
+                "split_midi": stage_split_midi,
+             "validate_midi": stage_validate_midi}
+
+def run_stage(stage, inputs, tmp_path, repeat=5):
+    # Best time of at least repeat runs, and the peak memory of one more traced run, since
+    # tracemalloc slows down allocations too much to time the same run
+    times = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        while len(times) < repeat or sum(times) < MIN_STAGE_TIME:
+            start = time.perf_counter()
+            n_items = stage(inputs, tmp_path)
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        stage(inputs, tmp_path)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {"items": n_items,
+          "seconds": min(times),
+       "throughput": n_items/max(min(times), 1e-9),
+      "peak_memory": peak_memory}
+
+def run_benchmark(scales, stages, repeat=5, seed=0):
+    results = {}
+    for scale in scales:
+        results[scale] = {}
+
+        with tempfile.TemporaryDirectory() as tmp_path:
+            size = SCALES[scale]
+            annotations_path, midi_path = generate_corpus(tmp_path, size["pieces"], size["annotators"], size["measures"], size["notes"], seed=seed)
+
+            phrases_path = os.path.join(tmp_path, "phrases")
+            os.makedirs(phrases_path)
+
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                inputs = prepare_inputs(annotations_path, midi_path)
+
+            for name in stages:
+                results[scale][name] = run_stage(STAGES[name], inputs, phrases_path, repeat)
+
+    return results
+
+def compare_results(results, baseline, tolerance=TOLERANCE):
+    # Throughput of every stage relative to the baseline. Stages missing from the baseline get None.
+    comparison = {}
+    for scale, stages in results.items():
+        for name, result in stages.items():
+            base = baseline.get(scale, {}).get(name)
+            if base is None:
+                comparison[(scale, name)] = None
+                continue
+
+            ratio = result["throughput"]/base["throughput"]
+            comparison[(scale, name)] = (ratio, ratio < 1 - tolerance)
+
+    return comparison
+
+def print_results(results, comparison=None):
+    print("{:8s} {:28s} {:>8s} {:>10s} {:>12s} {:>10s} {:>10s}".format("scale", "stage", "items", "seconds", "items/s", "peak MB", "baseline"))
+
+    for scale, stages in results.items():
+        for name, result in stages.items():
+            versus = ""
+            if comparison is not None and comparison[(scale, name)] is not None:
+                ratio, regression = comparison[(scale, name)]
+                versus = "{:.2f}x".format(ratio) + (" REGRESSION" if regression else "")
+
+            print("{:8s} {:28s} {:8d} {:10.4f} {:12.1f} {:10.2f} {:>10s}".format(scale, name, result["items"], result["seconds"], result["throughput"], result["peak_memory"]/2**20, versus))
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='benchmark.py')
+    parser.add_argument('--scales', type=str, nargs='+', default=["small", "medium"], choices=list(SCALES.keys()), help="Synthetic corpus sizes to benchmark.")
+    parser.add_argument('--stages', type=str, nargs='+', default=list(STAGES.keys()), choices=list(STAGES.keys()), help="Stages to benchmark.")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of timed runs per stage, the best one is reported.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the synthetic corpus.")
+    parser.add_argument('--baseline', type=str, default=None, help="Baseline json to compare against.")
+    parser.add_argument('--save_baseline', type=str, default=None, help="Path to save the results as a baseline json.")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="Max relative throughput drop before a stage is a regression.")
+    opt = parser.parse_args()
+
+    results = run_benchmark(opt.scales, opt.stages, opt.repeat, opt.seed)
+
+    comparison = None
+    if opt.baseline is not None:
+        with open(opt.baseline, "r") as fp:
+            comparison = compare_results(results, json.load(fp), opt.tolerance)
+
+    print_results(results, comparison)
+
+    if opt.save_baseline is not None:
+        with open(opt.save_baseline, "w") as fp:
+            json.dump(results, fp, indent=4)
+
+    # Fail on regressions, so the benchmark can gate changes
+    if comparison is not None and any(c is not None and c[1] for c in comparison.values()):
+        sys.exit(1)
@@ -1,71 +1,220 @@
 import os
 import sys
+import shutil
 import argparse
 import numpy as np
 
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
 from parse   import *
 from split   import *
 from cluster import *
-from plot    import plot_cluster
-
-# Parse arguments
-parser = argparse.ArgumentParser(description='train_generative.py')
-parser.add_argument('--annotations', type=str, required=True, help="Dir with annotation files.")
-parser.add_argument('--midi' , type=str, required=True, help="Dir with annotated midi files.")
-parser.add_argument('--phrases' , type=str, required=True, help="Phrases output path.")
-parser.add_argument('--plots' , type=str, required=True, help="Plots output path.")
-parser.add_argument('--at' , type=float, default=0.0, help="Ambiguity Threshold.")
-parser.set_defaults(rmdup=True)
-opt = parser.parse_args()
-
-# Parse music annotaion into a dict of pieces
-pieces = parse_annotation(opt.annotations)
-
-emotion_phrases = []
-for i, piece_id in enumerate(pieces):
-    # Get midi name without extension and path
-    midi_name = os.path.basename(pieces[piece_id]["midi"])
-    midi_path = os.path.join(opt.midi, midi_name)
+from cache   import *
+from archive import write_phrases_zip_dir
+from plot    import render_plot_job, save_plot_job
 
-    print("Processing...", midi_name)
+# Modules shared with the unlabelled scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+from tracing import *
 
-    valence_data = parse_emotion_dimension(pieces[piece_id], "valence")
-    arousal_data = parse_emotion_dimension(pieces[piece_id], "arousal")
+# Per piece stages of the --profile summary
+PROFILE_STAGES = ["parse", "cluster", "split", "write", "plot"]
 
-    # Cluster annotations of this midi file
-    valence_clustering, valence_best_cluster = cluster_annotations(valence_data)
-    arousal_clustering, arousal_best_cluster = cluster_annotations(arousal_data)
+def process_piece(piece_id, piece, opt):
+    # One span per piece, so workers flush their trace once per piece
+    with span("piece", os.path.splitext(os.path.basename(piece["midi"]))[0]):
+        return build_piece(piece_id, piece, opt)
+
+def build_piece(piece_id, piece, opt):
+    # Get midi name without extension and path
+    midi_name = os.path.basename(piece["midi"])
+    midi_path = os.path.join(opt.midi, midi_name)
+    midi_root = os.path.splitext(midi_name)[0]
 
-    # Find the medians of the best clusters
-    valence_median = np.mean(valence_clustering[valence_best_cluster], axis=0)
-    arousal_median = np.mean(arousal_clustering[arousal_best_cluster], axis=0)
+    # Skip pieces whose annotations, midi, threshold and code did not change
+    cache_key = None
+    if opt.cache is not None:
+        cache_key = piece_cache_key(piece, midi_path, piece_id, opt.at, opt.phrases, opt.plots)
 
-    # Make sure number of measures is the same for both dimensions
-    assert len(valence_median) == len(arousal_median)
+        cache_entry = load_cache_entry(opt.cache, cache_key)
+        if cache_entry is not None:
+            print("Cached...", midi_name)
+            count("cached_pieces")
 
-    # Split medians at the points of axis changes (from -1 to 1 or from 1 to -1)
-    emotion_chunks = split_annotation_by_emotion(valence_median, arousal_median, opt.at)
+            phrase_files = []
+            if opt.phrases_zip is not None:
+                phrase_files = cache_entry["phrase_files"]
+            else:
+                restore_cache_files(cache_entry["phrase_files"])
 
-    # Calculate measure length
-    measure_length = pieces[piece_id]["duration"]/pieces[piece_id]["measures"]
+            # Plots are redone from the cached cluster data only if they went missing
+            plot_jobs = [job for job in cache_entry["plot_jobs"] if not os.path.isfile(job[-1])]
+            return cache_entry["phrases"], plot_jobs, phrase_files
 
-    # Split midi file considering the median splits
-    midi_valence_parts = split_midi(piece_id, midi_path, emotion_chunks, measure_length, opt.phrases)
-    emotion_phrases += midi_valence_parts
+    print("Processing...", midi_name)
 
-    # Plot data
-    plot_valence_path = os.path.join(opt.plots, "valence")
-    if not os.path.isdir(plot_valence_path):
-        os.makedirs(plot_valence_path)
+    with span("parse", midi_root):
+        valence_data = parse_emotion_dimension(piece, "valence")
+        arousal_data = parse_emotion_dimension(piece, "arousal")
 
-    plot_valence_path = os.path.join(plot_valence_path, os.path.splitext(midi_name)[0] + ".png")
-    plot_cluster(valence_data, valence_clustering, valence_best_cluster, "Valence", "Clustering Valence", plot_valence_path)
+    # Cluster annotations of this midi file
+    with span("cluster", midi_root):
+        valence_clustering, valence_best_cluster = cluster_annotations(valence_data)
+        arousal_clustering, arousal_best_cluster = cluster_annotations(arousal_data)
 
-    plot_arousal_path = os.path.join(opt.plots, "arousal")
-    if not os.path.isdir(plot_arousal_path):
-        os.makedirs(plot_arousal_path)
+        # Find the medians of the best clusters
+        valence_median = np.mean(valence_clustering[valence_best_cluster], axis=0)
+        arousal_median = np.mean(arousal_clustering[arousal_best_cluster], axis=0)
 
-    plot_arousal_path = os.path.join(plot_arousal_path, os.path.splitext(midi_name)[0] + ".png")
-    plot_cluster(arousal_data, arousal_clustering, arousal_best_cluster, "Arousal", "Clustering Arousal", plot_arousal_path)
+    # Make sure number of measures is the same for both dimensions
+    assert len(valence_median) == len(arousal_median)
 
-persist_annotated_mids(emotion_phrases, "vgmidi.csv")
+    with span("split", midi_root):
+        # Split medians at the points of axis changes (from -1 to 1 or from 1 to -1)
+        emotion_chunks = split_annotation_by_emotion(valence_median, arousal_median, opt.at)
+
+        # Calculate measure length
+        measure_length = piece["duration"]/piece["measures"]
+
+        # Split midi file considering the median splits. Phrases going to a zip never touch the phrases dir.
+        midi_valence_parts, phrase_files = split_midi_phrases(piece_id, midi_path, emotion_chunks, measure_length, opt.phrases)
+
+    if opt.phrases_zip is None:
+        with span("write", midi_root):
+            write_midi_phrases(phrase_files)
+
+    # Plots are returned as jobs so rendering never blocks the data path. They are made
+    # whatever the plot mode, so cached pieces have them for runs of any mode.
+    plot_jobs = []
+    if opt.plots is not None:
+        plot_valence_path = os.path.join(opt.plots, "valence", os.path.splitext(midi_name)[0] + ".png")
+        plot_jobs.append((valence_data, valence_clustering, valence_best_cluster, "Valence", "Clustering Valence", plot_valence_path))
+
+        plot_arousal_path = os.path.join(opt.plots, "arousal", os.path.splitext(midi_name)[0] + ".png")
+        plot_jobs.append((arousal_data, arousal_clustering, arousal_best_cluster, "Arousal", "Clustering Arousal", plot_arousal_path))
+
+    if cache_key is not None:
+        with span("cache", midi_root):
+            save_cache_entry(opt.cache, cache_key, {"emotion_chunks": emotion_chunks,
+                                                           "phrases": midi_valence_parts,
+                                                      "phrase_files": phrase_files,
+                                                         "plot_jobs": plot_jobs})
+
+    if opt.phrases_zip is None:
+        phrase_files = []
+
+    return midi_valence_parts, plot_jobs, phrase_files
+
+def dispatch_plot_jobs(plot_jobs, plot_mode, plot_executor):
+    # Jobs of plot mode none are dropped
+    plot_futures = []
+    for plot_job in plot_jobs:
+        if plot_mode == "lazy":
+            save_plot_job(plot_job)
+        elif plot_mode == "all":
+            plot_futures.append(plot_executor.submit(render_plot_job, plot_job))
+
+    return plot_futures
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='train_generative.py')
+    parser.add_argument('--annotations', type=str, required=True, help="Dir with annotation files or compiled annotation store.")
+    parser.add_argument('--midi' , type=str, required=True, help="Dir with annotated midi files.")
+    parser.add_argument('--phrases' , type=str, required=True, help="Phrases output path.")
+    parser.add_argument('--phrases_zip' , type=str, default=None, help="Write phrases to this zip instead of the phrases dir.")
+    parser.add_argument('--out' , type=str, default="vgmidi.csv", help="Phrases csv output path.")
+    parser.add_argument('--resume' , action='store_true', help="Skip the pieces a previous, interrupted run already wrote to the csv.")
+    parser.add_argument('--plots' , type=str, default=None, help="Plots output path.")
+    parser.add_argument('--plot_mode' , type=str, default="all", choices=["none", "lazy", "all"], help="Render all plots, save cluster data to render them later or skip them.")
+    parser.add_argument('--plot_workers' , type=int, default=1, help="Number of plot worker processes.")
+    parser.add_argument('--at' , type=float, default=0.0, help="Ambiguity Threshold.")
+    parser.add_argument('--workers' , type=int, default=1, help="Number of worker processes.")
+    parser.add_argument('--cache' , type=str, default=None, help="Dir to cache processed pieces in.")
+    parser.add_argument('--cache_size' , type=int, default=CACHE_SIZE, help="Max cache size in megabytes.")
+    parser.add_argument('--profile' , type=str, default=None, help="Time every stage of every piece, save a chrome trace to this path and print the slowest pieces.")
+    parser.set_defaults(rmdup=True)
+    opt = parser.parse_args()
+
+    if opt.plot_mode != "none":
+        if opt.plots is None:
+            parser.error("--plots is required unless --plot_mode is none")
+
+        # Create plot dirs once, before any worker tries to write to them
+        for dimension in ["valence", "arousal"]:
+            plot_path = os.path.join(opt.plots, dimension)
+            if not os.path.isdir(plot_path):
+                os.makedirs(plot_path)
+
+    # Workers append their spans to the trace dir as they finish pieces
+    trace_dir = None
+    if opt.profile is not None:
+        trace_dir = start_tracing()
+
+    # Parse music annotaion into a dict of pieces
+    with span("parse_annotation"):
+        pieces = parse_annotation(opt.annotations)
+
+    # Plots are rendered by their own pool, so the data path doesn't wait on png encoding
+    plot_executor = None
+    if opt.plot_mode == "all":
+        plot_executor = ProcessPoolExecutor(max_workers=opt.plot_workers, initializer=enable_tracing, initargs=(trace_dir,))
+
+    # Rows are written as pieces finish, so a crash only loses the pieces in flight
+    phrase_stream = PhraseCsvStream(opt.out, opt.resume)
+    piece_ids = [piece_id for piece_id in pieces if piece_id not in phrase_stream]
+    if len(phrase_stream) > 0:
+        print("Resuming...", len(phrase_stream), "pieces already done")
+
+    # Phrases going to a zip are staged next to it until every piece is done
+    staging_path = None
+    if opt.phrases_zip is not None:
+        staging_path = opt.phrases_zip + ".parts"
+        if not opt.resume:
+            shutil.rmtree(staging_path, ignore_errors=True)
+        os.makedirs(staging_path, exist_ok=True)
+
+    # Pieces are independent, so process them in parallel. Executor.map returns
+    # results in submission order, which keeps the csv identical to a serial run.
+    data_executor = None
+    if opt.workers > 1:
+        data_executor = ProcessPoolExecutor(max_workers=opt.workers, initializer=enable_tracing, initargs=(trace_dir,))
+        results = data_executor.map(process_piece, piece_ids, [pieces[i] for i in piece_ids], repeat(opt))
+    else:
+        results = map(process_piece, piece_ids, [pieces[i] for i in piece_ids], repeat(opt))
+
+    plot_futures = []
+    for piece_id, (midi_valence_parts, plot_jobs, midi_phrase_files) in zip(piece_ids, results):
+        plot_futures += dispatch_plot_jobs(plot_jobs, opt.plot_mode, plot_executor)
+
+        # Phrases must be on disk before the piece is checkpointed
+        if staging_path is not None:
+            write_midi_phrases([(os.path.join(staging_path, os.path.basename(p)), b) for p, b in midi_phrase_files])
+
+        phrase_stream.append(piece_id, midi_valence_parts)
+
+    if data_executor is not None:
+        data_executor.shutdown()
+
+    with span("write_csv"):
+        phrase_stream.finish()
+
+    if opt.phrases_zip is not None:
+        with span("write_zip"):
+            write_phrases_zip_dir(opt.phrases_zip, staging_path)
+        shutil.rmtree(staging_path)
+
+    if opt.cache is not None:
+        evict_cache(opt.cache, opt.cache_size)
+
+    # Wait for the remaining plots
+    if plot_executor is not None:
+        for plot_future in plot_futures:
+            plot_future.result()
+        plot_executor.shutdown()
+
+    if trace_dir is not None:
+        events, counters, rss = stop_tracing(trace_dir)
+        write_chrome_trace(events, rss, opt.profile)
+        print_trace_summary(events, counters, rss, PROFILE_STAGES)
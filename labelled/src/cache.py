@@ -0,0 +1,153 @@
+import os
+import ast
+import pickle
+import hashlib
+import functools
+import numpy as np
+
+# Sources whose changes, or changes to any local module they import, invalidate every cached piece
+CACHE_SOURCES = ["build_dataset.py"]
+
+# Dirs local modules are imported from, this one and the modules shared with the unlabelled scripts
+SOURCE_DIRS = [os.path.dirname(os.path.abspath(__file__)),
+               os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common")]
+
+# Default cache size in megabytes
+CACHE_SIZE = 1024
+
+def find_source(module_name):
+    for source_dir in SOURCE_DIRS:
+        source_path = os.path.join(source_dir, module_name + ".py")
+        if os.path.isfile(source_path):
+            return source_path
+
+    return None
+
+def local_sources(source_paths):
+    # Sources and the local modules they import, directly or not, in a stable order
+    sources = []
+    pending = list(source_paths)
+    while len(pending) > 0:
+        source_path = pending.pop(0)
+        if source_path in sources:
+            continue
+        sources.append(source_path)
+
+        with open(source_path, "rb") as fp:
+            tree = ast.parse(fp.read())
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                module_names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                module_names = [node.module]
+            else:
+                continue
+
+            # Packages like numpy are never found in the source dirs
+            for module_name in module_names:
+                module_path = find_source(module_name)
+                if module_path is not None:
+                    pending.append(module_path)
+
+    return sources
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    md5 = hashlib.md5()
+    for source_path in local_sources([find_source(os.path.splitext(f)[0]) for f in CACHE_SOURCES]):
+        with open(source_path, "rb") as fp:
+            md5.update(fp.read())
+
+    return md5.hexdigest()
+
+def piece_cache_key(piece, midi_path, *params):
+    md5 = hashlib.md5()
+
+    # Annotation rows of the piece
+    for dimension_name in ["valence", "arousal"]:
+        for d in piece[dimension_name]:
+            md5.update(np.asarray(d, dtype=np.float64).tobytes())
+            md5.update(b"|")
+        md5.update(b"#")
+
+    md5.update(repr((piece["measures"], piece["duration"])).encode("utf-8"))
+
+    # Midi file contents
+    with open(midi_path, "rb") as fp:
+        md5.update(fp.read())
+
+    # Pipeline parameters and code version
+    md5.update(repr(params).encode("utf-8"))
+    md5.update(code_version().encode("utf-8"))
+
+    return md5.hexdigest()
+
+def cache_entry_path(cache_path, key):
+    return os.path.join(cache_path, key + ".pkl")
+
+def load_cache_entry(cache_path, key):
+    entry_path = cache_entry_path(cache_path, key)
+    if not os.path.isfile(entry_path):
+        return None
+
+    try:
+        with open(entry_path, "rb") as fp:
+            entry = pickle.load(fp)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        print("----", "Cache entry seems corrupt.")
+        return None
+
+    # Touch the entry so eviction drops the least recently used ones first
+    os.utime(entry_path)
+
+    return entry
+
+def save_cache_entry(cache_path, key, entry):
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path, exist_ok=True)
+
+    # Write to a temp file first so concurrent workers never read half an entry
+    entry_path = cache_entry_path(cache_path, key)
+    tmp_path = entry_path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "wb") as fp:
+        pickle.dump(entry, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp_path, entry_path)
+
+def cached_file_matches(path, data):
+    # Phrase names don't depend on the threshold, so a file of the same name
+    # may hold the phrase of another run
+    if not os.path.isfile(path) or os.path.getsize(path) != len(data):
+        return False
+
+    with open(path, "rb") as fp:
+        return fp.read() == data
+
+def restore_cache_files(files):
+    # Only write back the outputs that went missing or changed since the entry was made
+    for path, data in files:
+        if not cached_file_matches(path, data):
+            with open(path, "wb") as fp:
+                fp.write(data)
+
+def evict_cache(cache_path, max_size=CACHE_SIZE):
+    if not os.path.isdir(cache_path):
+        return
+
+    entries = []
+    for filename in os.listdir(cache_path):
+        if os.path.splitext(filename)[1] != ".pkl":
+            continue
+
+        stat = os.stat(os.path.join(cache_path, filename))
+        entries.append((stat.st_mtime, stat.st_size, filename))
+
+    # Remove least recently used entries until the cache fits in max_size megabytes
+    total_size = sum(e[1] for e in entries)
+    for mtime, size, filename in sorted(entries):
+        if total_size <= max_size * 1024 * 1024:
+            break
+
+        os.remove(os.path.join(cache_path, filename))
+        total_size -= size
@@ -0,0 +1,248 @@
+import io
+import os
+import sys
+import csv
+import sqlite3
+import hashlib
+import argparse
+import pretty_midi
+
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+from rolls import MidiResolver
+
+# Modules shared with the unlabelled scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+from midi_scan import scan_midi_bytes, MidiScanUnsupported
+
+# Csv columns of a piece, then what is known about its midi file. Labelled rows have
+# valence and arousal, unlabelled rows a pdf.
+CSV_COLUMNS = ["id", "series", "console", "game", "piece", "midi", "pdf", "valence", "arousal"]
+FILE_COLUMNS = ["source", "mtime", "size", "md5", "duration"]
+
+SCHEMA = """
+CREATE TABLE pieces (dataset TEXT NOT NULL,
+                          id INTEGER,
+                      series TEXT,
+                     console TEXT,
+                        game TEXT,
+                       piece TEXT,
+                        midi TEXT NOT NULL,
+                         pdf TEXT,
+                     valence INTEGER,
+                     arousal INTEGER,
+                      source TEXT,
+                       mtime INTEGER,
+                        size INTEGER,
+                         md5 TEXT,
+                    duration REAL);
+
+CREATE UNIQUE INDEX pieces_midi ON pieces (dataset, midi);
+CREATE INDEX pieces_series ON pieces (series);
+CREATE INDEX pieces_console ON pieces (console);
+CREATE INDEX pieces_game ON pieces (game);
+CREATE INDEX pieces_piece ON pieces (piece);
+CREATE INDEX pieces_duration ON pieces (duration);
+CREATE INDEX pieces_md5 ON pieces (md5);
+"""
+
+# Columns queries can filter on with an equality
+QUERY_COLUMNS = ["dataset", "series", "console", "game", "piece", "md5"]
+
+def midi_duration(midi_bytes):
+    # Scan raw events for the end time, falling back to a full parse like midi_clean does
+    try:
+        return scan_midi_bytes(midi_bytes)[1]
+    except MidiScanUnsupported:
+        pass
+
+    try:
+        return pretty_midi.PrettyMIDI(io.BytesIO(midi_bytes)).get_end_time()
+    except Exception:
+        return None
+
+def midi_file_info(midi_path, read_midi):
+    # Size, hash and duration of a midi file, or None if it can't be found
+    source = read_midi.locate(midi_path)
+    if not os.path.isfile(source):
+        return None
+
+    midi_bytes = read_midi.read_bytes(midi_path)
+    return {"source": source,
+             "mtime": os.stat(source).st_mtime_ns,
+              "size": len(midi_bytes),
+               "md5": hashlib.md5(midi_bytes).hexdigest(),
+          "duration": midi_duration(midi_bytes)}
+
+def load_file_infos(db_path):
+    # File columns of a previous catalog, keyed by midi path
+    file_infos = {}
+    if not os.path.isfile(db_path):
+        return file_infos
+
+    try:
+        db = sqlite3.connect(db_path)
+        for row in db.execute("SELECT midi, " + ", ".join(FILE_COLUMNS) + " FROM pieces WHERE source IS NOT NULL"):
+            file_infos[row[0]] = dict(zip(FILE_COLUMNS, row[1:]))
+        db.close()
+    except sqlite3.Error:
+        # Not a catalog, or an older one, so every file is read again
+        pass
+
+    return file_infos
+
+def build_catalog(db_path, csv_paths, read_midi, workers=1):
+    rows = []
+    for csv_path in csv_paths:
+        dataset = os.path.splitext(os.path.basename(csv_path))[0]
+        for row in csv.DictReader(open(csv_path, "r")):
+            rows.append(dict({c: row.get(c) for c in CSV_COLUMNS}, dataset=dataset))
+
+    # Files that didn't change since the previous build keep their size, hash and duration
+    previous_infos = load_file_infos(db_path)
+
+    file_infos, midi_paths = {}, []
+    for row in rows:
+        info = previous_infos.get(row["midi"])
+        source = read_midi.locate(row["midi"])
+        if info is not None and info["source"] == source and os.path.isfile(source) and info["mtime"] == os.stat(source).st_mtime_ns:
+            file_infos[row["midi"]] = info
+        elif row["midi"] not in file_infos:
+            file_infos[row["midi"]] = None
+            midi_paths.append(row["midi"])
+
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        infos = executor.map(midi_file_info, midi_paths, repeat(read_midi), chunksize=16)
+    else:
+        infos = map(midi_file_info, midi_paths, repeat(read_midi))
+
+    for midi_path, info in zip(midi_paths, infos):
+        if info is not None:
+            print("Cataloged...", midi_path)
+        file_infos[midi_path] = info
+
+    if executor is not None:
+        executor.shutdown()
+
+    # Build a new database next to the old one, so readers never see half a catalog
+    tmp_path = db_path + ".tmp"
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+
+    db = sqlite3.connect(tmp_path)
+    db.executescript(SCHEMA)
+
+    columns = ["dataset"] + CSV_COLUMNS + FILE_COLUMNS
+    insert = "INSERT OR REPLACE INTO pieces (" + ", ".join(columns) + ") VALUES (" + ", ".join("?" * len(columns)) + ")"
+
+    empty_info = dict.fromkeys(FILE_COLUMNS)
+    db.executemany(insert, ([row[c] for c in ["dataset"] + CSV_COLUMNS] + [(file_infos[row["midi"]] or empty_info)[c] for c in FILE_COLUMNS] for row in rows))
+
+    db.commit()
+    db.execute("ANALYZE")
+    db.close()
+
+    os.replace(tmp_path, db_path)
+
+class Catalog:
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM pieces").fetchone()[0]
+
+    def where(self, min_duration=None, max_duration=None, found=False, **filters):
+        # Sql conditions and parameters of a query, every condition can use an index
+        conditions, params = [], []
+        for column, value in filters.items():
+            if column not in QUERY_COLUMNS:
+                raise ValueError("Can't filter on column " + column)
+
+            if value is not None:
+                conditions.append(column + " = ?")
+                params.append(value)
+
+        if min_duration is not None:
+            conditions.append("duration > ?")
+            params.append(min_duration)
+
+        if max_duration is not None:
+            conditions.append("duration <= ?")
+            params.append(max_duration)
+
+        if found:
+            conditions.append("source IS NOT NULL")
+
+        if len(conditions) == 0:
+            return "", params
+
+        return " WHERE " + " AND ".join(conditions), params
+
+    def query(self, order_by="midi", **filters):
+        # Rows matching every filter, like query(console="SNES", series="Mario", min_duration=60)
+        if order_by not in ["dataset"] + CSV_COLUMNS + FILE_COLUMNS:
+            raise ValueError("Can't order by column " + order_by)
+
+        where, params = self.where(**filters)
+        return [dict(row) for row in self.db.execute("SELECT * FROM pieces" + where + " ORDER BY " + order_by, params)]
+
+    def count(self, group_by, **filters):
+        # Number of rows of every value of a column, like count("game", dataset="vgmidi_unlabelled")
+        if group_by not in QUERY_COLUMNS:
+            raise ValueError("Can't group by column " + group_by)
+
+        where, params = self.where(**filters)
+        return dict(self.db.execute("SELECT " + group_by + ", COUNT(*) FROM pieces" + where + " GROUP BY " + group_by, params).fetchall())
+
+    def explain(self, **filters):
+        # Sqlite's plan of a query, to check it is an index lookup
+        where, params = self.where(**filters)
+        return [row[-1] for row in self.db.execute("EXPLAIN QUERY PLAN SELECT * FROM pieces" + where, params)]
+
+    def close(self):
+        self.db.close()
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='catalog.py')
+    parser.add_argument('--db', type=str, required=True, help="Catalog database path.")
+    parser.add_argument('--csv', type=str, nargs='+', default=None, help="Build the catalog from these csvs, like vgmidi_labelled.csv and vgmidi_unlabelled.csv.")
+    parser.add_argument('--root', type=str, default=".", help="Dir the csv midi paths are relative to.")
+    parser.add_argument('--midi', type=str, default=None, help="Dir to look midi files up by name.")
+    parser.add_argument('--zip', type=str, default=None, help="Phrases zip to look midi files up in.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes.")
+    parser.add_argument('--dataset', type=str, default=None, help="Only rows of this csv, like vgmidi_unlabelled.")
+    parser.add_argument('--series', type=str, default=None, help="Only rows of this series.")
+    parser.add_argument('--console', type=str, default=None, help="Only rows of this console.")
+    parser.add_argument('--game', type=str, default=None, help="Only rows of this game.")
+    parser.add_argument('--piece', type=str, default=None, help="Only rows of this piece.")
+    parser.add_argument('--min_duration', type=float, default=None, help="Only rows longer than this many seconds.")
+    parser.add_argument('--max_duration', type=float, default=None, help="Only rows at most this many seconds long.")
+    parser.add_argument('--found', action='store_true', help="Only rows whose midi file was found.")
+    parser.add_argument('--out', type=str, default=None, help="Save the matching rows to this csv instead of printing them.")
+    opt = parser.parse_args()
+
+    if opt.csv is not None:
+        build_catalog(opt.db, opt.csv, MidiResolver(opt.root, opt.midi, opt.zip), opt.workers)
+
+    catalog = Catalog(opt.db)
+    rows = catalog.query(dataset=opt.dataset, series=opt.series, console=opt.console, game=opt.game, piece=opt.piece,
+                         min_duration=opt.min_duration, max_duration=opt.max_duration, found=opt.found)
+
+    fp = sys.stdout
+    if opt.out is not None:
+        fp = open(opt.out, "w")
+
+    writer = csv.DictWriter(fp, fieldnames=["dataset"] + CSV_COLUMNS + FILE_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+    if opt.out is not None:
+        fp.close()
+
+    print("Matching rows:", len(rows), "of", len(catalog), file=sys.stderr)
+    catalog.close()
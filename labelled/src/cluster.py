@@ -5,7 +5,11 @@ from sklearn.cluster import AgglomerativeClustering
 from tslearn.clustering import TimeSeriesKMeans
 
 def moving_average(x, w):
-    return np.convolve(x, np.ones(w), 'valid') / w
+    # Cumulative-sum kernel along the last axis, so it works on series, matrices and tensors
+    x = np.asarray(x, dtype=np.float64)
+    c = np.cumsum(x, axis=-1)
+    c = np.concatenate([np.zeros(x.shape[:-1] + (1,)), c], axis=-1)
+    return (c[..., w:] - c[..., :-w]) / w
 
 def nearest_to_centroid(xs):
     centroid = np.mean(xs, axis=0)
@@ -13,7 +17,7 @@ def nearest_to_centroid(xs):
     return xs[np.argmin(dist)]
 
 def cluster_annotation_dimension(data, n_clusters=3):
-    data = np.array([list(moving_average(d, 2)) for d in data])
+    data = moving_average(data, 2)
 
     clustering = TimeSeriesKMeans(n_clusters=n_clusters, metric="euclidean")
     clustering.fit(data)
@@ -66,3 +70,78 @@ def get_majority_cluster(clustering):
         print("Selected", majority_cluster_ix)
 
     return majority_cluster_ix
+
+def bucket_annotations(datas):
+    # Group pieces by number of measures and stack each group into a
+    # (n_pieces, max_annotators, n_measures) tensor. Missing annotators are NaN.
+    buckets = {}
+    for i, data in enumerate(datas):
+        n_measures = data.shape[1]
+        if n_measures not in buckets:
+            buckets[n_measures] = []
+        buckets[n_measures].append(i)
+
+    tensors = []
+    for n_measures, piece_ixs in buckets.items():
+        n_annotators = max(len(datas[i]) for i in piece_ixs)
+
+        tensor = np.full((len(piece_ixs), n_annotators, n_measures), np.nan)
+        for j, i in enumerate(piece_ixs):
+            tensor[j, :len(datas[i])] = datas[i]
+
+        tensors.append((piece_ixs, tensor))
+
+    return tensors
+
+def seperate_annotation_dimensions(tensor):
+    # Sign split of every piece in a bucket tensor. NaN rows belong to no cluster.
+    data_mean = np.mean(tensor, axis=2)
+    return [data_mean < 0, data_mean > 0]
+
+def batch_kmeans(tensor, n_clusters=3, max_iter=50, random_state=0):
+    # Lloyd's k-means run independently for every piece of a bucket tensor
+    valid = ~np.isnan(tensor).any(axis=2)
+    data = np.where(valid[:, :, None], tensor, 0)
+    n_pieces, n_annotators, n_measures = data.shape
+
+    # Start from n_clusters distinct random annotators of each piece
+    rng = np.random.RandomState(random_state)
+    init_order = np.argsort(np.where(valid, rng.rand(n_pieces, n_annotators), np.inf), axis=1)
+    centroids = np.take_along_axis(data, init_order[:, :n_clusters, None], axis=1)
+
+    labels = np.full((n_pieces, n_annotators), -1)
+    for it in range(max_iter):
+        dist = np.sum((data[:, :, None, :] - centroids[:, None, :, :])**2, axis=3)
+        new_labels = np.where(valid, np.argmin(dist, axis=2), -1)
+
+        if (new_labels == labels).all():
+            break
+        labels = new_labels
+
+        # Move centroids to the mean of their annotators, keep the empty ones in place
+        one_hot = (labels[:, :, None] == np.arange(n_clusters)).astype(np.float64)
+        counts = one_hot.sum(axis=1)
+        sums = np.einsum("pak,pam->pkm", one_hot, data)
+        centroids = np.where(counts[:, :, None] > 0, sums / np.maximum(counts, 1)[:, :, None], centroids)
+
+    return [labels == k for k in range(n_clusters)]
+
+def cluster_annotations_batch(datas, method="sign", n_clusters=3, random_state=0):
+    # Cluster the annotations of many pieces at once. Returns one
+    # (clustering, majority_cluster) pair per piece, like cluster_annotations.
+    results = [None] * len(datas)
+
+    for piece_ixs, tensor in bucket_annotations(datas):
+        if method == "sign":
+            masks = seperate_annotation_dimensions(tensor)
+        elif method == "kmeans":
+            tensor = moving_average(tensor, 2)
+            masks = batch_kmeans(tensor, n_clusters, random_state=random_state)
+        else:
+            raise ValueError("Unknown clustering method " + method)
+
+        for j, i in enumerate(piece_ixs):
+            clustering = [tensor[j][mask[j]] for mask in masks]
+            results[i] = (clustering, get_majority_cluster(clustering))
+
+    return results
@@ -0,0 +1,131 @@
+import os
+import csv
+import argparse
+import threading
+import collections
+import pretty_midi
+import numpy as np
+
+from archive import PhraseArchive
+from concurrent.futures import ThreadPoolExecutor
+
+# Max number of parsed pieces kept in memory
+PHRASE_CACHE_SIZE = 256
+
+# Number of pieces parsed ahead of the one being read
+PREFETCH_DEPTH = 8
+PREFETCH_WORKERS = 2
+
+class PhraseDataset:
+    # Pieces listed in a csv written by persist_annotated_mids, parsed on demand
+    def __init__(self, csv_path, root=".", cache_size=PHRASE_CACHE_SIZE, workers=PREFETCH_WORKERS, read_midi=None):
+        self.root = root
+        self.rows = list(csv.DictReader(open(csv_path, "r")))
+
+        self.read_midi = read_midi
+        if self.read_midi is None:
+            self.read_midi = lambda midi_path: pretty_midi.PrettyMIDI(os.path.join(self.root, midi_path))
+
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        self.executor = None
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        row = self.rows[i]
+        return self.load(i), int(row["valence"]), int(row["arousal"])
+
+    def __iter__(self):
+        return self.epoch()
+
+    def cache_piece(self, i, midi_data):
+        with self.lock:
+            self.cache[i] = midi_data
+            self.cache.move_to_end(i)
+            self.pending.pop(i, None)
+
+            # Drop least recently used pieces
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def parse(self, i):
+        try:
+            midi_data = self.read_midi(self.rows[i]["midi"])
+        except BaseException:
+            # Drop a failed prefetch, so the next load of the piece tries again
+            with self.lock:
+                self.pending.pop(i, None)
+            raise
+
+        self.cache_piece(i, midi_data)
+        return midi_data
+
+    def load(self, i):
+        with self.lock:
+            if i in self.cache:
+                self.cache.move_to_end(i)
+                return self.cache[i]
+
+            future = self.pending.get(i)
+
+        # Wait for a prefetch of this piece instead of parsing it twice
+        if future is not None:
+            return future.result()
+
+        return self.parse(i)
+
+    def prefetch(self, indices):
+        if self.executor is None:
+            return
+
+        with self.lock:
+            indices = [i for i in indices if i not in self.cache and i not in self.pending]
+            for i in indices:
+                self.pending[i] = self.executor.submit(self.parse, i)
+
+    def epoch(self, order=None, depth=PREFETCH_DEPTH):
+        # Iterate in the given order, parsing the next pieces of the order in the background
+        if order is None:
+            order = range(len(self))
+
+        order = list(order)
+        depth = min(depth, self.cache_size - 1)
+        for k, i in enumerate(order):
+            self.prefetch(order[k + 1:k + 1 + depth])
+            yield self[i]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='loader.py')
+    parser.add_argument('--csv', type=str, required=True, help="Labelled dataset csv.")
+    parser.add_argument('--root', type=str, default=".", help="Dir the csv midi paths are relative to.")
+    parser.add_argument('--zip', type=str, default=None, help="Read phrases straight from this zip, like labelled/phrases.zip.")
+    parser.add_argument('--workers', type=int, default=PREFETCH_WORKERS, help="Number of prefetch threads.")
+    parser.add_argument('--epochs', type=int, default=1, help="Number of shuffled epochs to iterate.")
+    opt = parser.parse_args()
+
+    read_midi = None
+    if opt.zip is not None:
+        read_midi = PhraseArchive(opt.zip).read_midi
+
+    dataset = PhraseDataset(opt.csv, opt.root, workers=opt.workers, read_midi=read_midi)
+
+    for epoch in range(opt.epochs):
+        total_time = 0
+        for midi_data, valence, arousal in dataset.epoch(np.random.permutation(len(dataset))):
+            total_time += midi_data.get_end_time()
+
+        print("Epoch", epoch, "pieces:", len(dataset), "total time (in seconds):", total_time)
+
+    dataset.close()
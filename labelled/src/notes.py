@@ -0,0 +1,61 @@
+import io
+import pretty_midi
+import numpy as np
+
+# One row per note instead of one pretty_midi.Note object. Times stay float64 seconds,
+# so slices come out exactly as the Note based code computed them.
+NOTE_DTYPE = np.dtype([("start", np.float64),
+                         ("end", np.float64),
+                       ("pitch", np.uint8),
+                    ("velocity", np.uint8),
+                     ("program", np.uint8)])
+
+def midi_to_notes(midi_data, drums=False):
+    # Notes in instrument order, then in the order of each instrument's notes
+    instruments = [inst for inst in midi_data.instruments if drums or not inst.is_drum]
+
+    notes = np.empty(sum(len(inst.notes) for inst in instruments), dtype=NOTE_DTYPE)
+
+    offset = 0
+    for inst in instruments:
+        notes[offset:offset + len(inst.notes)] = [(n.start, n.end, n.pitch, n.velocity, inst.program) for n in inst.notes]
+        offset += len(inst.notes)
+
+    return notes
+
+def notes_to_midi(notes, resolution=220, program=None):
+    # One instrument per program, in order of their first note. If program is given,
+    # every note goes to a single instrument of that program instead.
+    midi_data = pretty_midi.PrettyMIDI(resolution=resolution)
+
+    if program is not None:
+        groups = [(program, notes)]
+    else:
+        programs, first = np.unique(notes["program"], return_index=True)
+        groups = [(p, notes[notes["program"] == p]) for p in programs[np.argsort(first)]]
+
+    for group_program, group_notes in groups:
+        instrument = pretty_midi.Instrument(program=int(group_program))
+        for start, end, pitch, velocity, _ in group_notes.tolist():
+            instrument.notes.append(pretty_midi.Note(velocity, pitch, start, end))
+        midi_data.instruments.append(instrument)
+
+    return midi_data
+
+def shift_notes(notes, offset):
+    # Copy of the notes moved by offset seconds
+    shifted = notes.copy()
+    shifted["start"] += offset
+    shifted["end"] += offset
+    return shifted
+
+def slice_notes(notes, start, end):
+    # Notes starting in [start, end), moved so the slice starts at 0
+    starts = notes["start"]
+    return shift_notes(notes[(starts >= start) & (starts < end)], -float(start))
+
+def serialize_notes(notes, resolution=220, program=None):
+    # Midi file bytes of the notes, written to an in-memory buffer
+    buffer = io.BytesIO()
+    notes_to_midi(notes, resolution, program).write(buffer)
+    return buffer.getvalue()
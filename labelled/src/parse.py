@@ -1,85 +1,33 @@
 import os
 import csv
 import json
+import heapq
 import argparse
+import itertools
 import numpy as np
 
-def parse_json(filename):
-    file = open(filename, "r")
-    parsed_json = json.loads(file.read())
-    return parsed_json
+from store import AnnotationStore, is_annotation_store, ingest_annotations
 
-def parse_annotation(annotations_path):
-    annotation_rounds = []
-
-    for filename in os.listdir(annotations_path):
-        if os.path.splitext(filename)[1] != ".json":
-            continue
-
-        data = parse_json(os.path.join(annotations_path, filename))
-
-        pieces = {}
-        for annotation_id in data['annotations']:
-            piece_id = annotation_id.split("_")[0]
-            if piece_id not in data['pieces']:
-                continue
+# Columns of the phrases csv
+PHRASE_CSV_COLUMNS = ['id','series','console', 'game', 'piece', 'midi', 'valence', 'arousal']
 
-            if piece_id not in pieces:
-                pieces[piece_id] = {}
-                pieces[piece_id]["name"] = data["pieces"][piece_id]["name"]
-                pieces[piece_id]["midi"] = data["pieces"][piece_id]["midi"]
-                pieces[piece_id]["measures"] = data["pieces"][piece_id]["measures"]
-                pieces[piece_id]["duration"] = data["pieces"][piece_id]["duration"]
-                pieces[piece_id]["arousal"] = []
-                pieces[piece_id]["valence"] = []
+# Number of rows sorted in memory at a time when sorting a streamed csv
+SORT_CHUNK_ROWS = 100000
 
-            pieces[piece_id]["arousal"].append(data['annotations'][annotation_id]['arousal'])
-            pieces[piece_id]["valence"].append(data['annotations'][annotation_id]['valence'])
-
-        annotation_rounds.append(pieces)
-
-    joint_pieces = {}
-
-    joint_piece_id = 0
-    for pieces in annotation_rounds:
-        for id, piece in pieces.items():
-            joint_pieces["piece_" + str(joint_piece_id)] = piece
-            joint_piece_id += 1
+def parse_annotation(annotations_path):
+    # Compiled stores are memory-mapped instead of decoding the json rounds
+    if is_annotation_store(annotations_path):
+        return AnnotationStore(annotations_path)
 
-    return joint_pieces
+    pieces, demographics = ingest_annotations(annotations_path)
+    return pieces
 
 def parse_demographics(annotations_path):
-    total_annotations = 0
+    if is_annotation_store(annotations_path):
+        return AnnotationStore(annotations_path).demographics()
 
-    age, gender, musicianship = {}, {}, {}
-    for filename in os.listdir(annotations_path):
-        if os.path.splitext(filename)[1] != ".json":
-            continue
-
-        data = parse_json(os.path.join(annotations_path, filename))
-
-        for ann in data["annotations"]:
-            piece_ann = data["annotations"][ann]
-
-            if piece_ann["gender"] not in gender:
-                gender[piece_ann["gender"]] = 0
-            gender[piece_ann["gender"]] += 1
-
-            if piece_ann["age"] not in age:
-                age[piece_ann["age"]] = 0
-            age[piece_ann["age"]] += 1
-
-            if piece_ann["musicianship"] not in musicianship:
-                musicianship[piece_ann["musicianship"]] = 0
-            musicianship[piece_ann["musicianship"]] += 1
-
-            total_annotations += 1
-
-    age = {k: v/total_annotations for k,v in age.items()}
-    gender = {k: v/total_annotations for k,v in gender.items()}
-    musicianship = {k: v/total_annotations for k,v in musicianship.items()}
-
-    return age, gender, musicianship
+    pieces, demographics = ingest_annotations(annotations_path)
+    return demographics.frequencies()
 
 def parse_emotion_dimension(piece, dimension_name, max_variance=0.1):
     # Get most frequent_len
@@ -101,23 +49,131 @@ def parse_emotion_dimension(piece, dimension_name, max_variance=0.1):
     return data_dimension
 
 def persist_annotated_mids(annotated_pieces, output_path):
-    fieldnames = ['id','series','console', 'game', 'piece', 'midi', 'valence', 'arousal']
-
     with open(output_path, mode='w') as fp:
-        fp_writer = csv.DictWriter(fp, fieldnames=fieldnames)
+        fp_writer = csv.DictWriter(fp, fieldnames=PHRASE_CSV_COLUMNS)
         fp_writer.writeheader()
 
         for piece in sorted(annotated_pieces, key=lambda k: k['midi']):
             fp_writer.writerow(piece)
 
+def sort_phrase_csv(rows_path, output_path, chunk_rows=SORT_CHUNK_ROWS):
+    # External merge sort of headerless phrase rows by midi, into the csv persist_annotated_mids
+    # would write. Sorted runs of chunk_rows rows go to temp files, so memory stays flat.
+    midi_column = PHRASE_CSV_COLUMNS.index('midi')
+
+    run_paths = []
+    with open(rows_path, "r", newline="") as fp:
+        reader = csv.reader(fp)
+        while True:
+            chunk = list(itertools.islice(reader, chunk_rows))
+            if len(chunk) == 0:
+                break
+
+            chunk.sort(key=lambda row: row[midi_column])
+
+            run_path = rows_path + ".run" + str(len(run_paths))
+            with open(run_path, "w") as run_fp:
+                csv.writer(run_fp).writerows(chunk)
+            run_paths.append(run_path)
+
+    run_fps = [open(run_path, "r", newline="") for run_path in run_paths]
+
+    # Rows are only visible at output_path once all of them are written
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, mode='w') as fp:
+        fp_writer = csv.writer(fp)
+        fp_writer.writerow(PHRASE_CSV_COLUMNS)
+        fp_writer.writerows(heapq.merge(*[csv.reader(run_fp) for run_fp in run_fps], key=lambda row: row[midi_column]))
+
+    for run_fp, run_path in zip(run_fps, run_paths):
+        run_fp.close()
+        os.remove(run_path)
+
+    os.replace(tmp_path, output_path)
+
+def load_checkpoint(checkpoint_path):
+    # Piece ids of the checkpoint, with the size of the rows file once their rows were written
+    done = {}
+    if not os.path.isfile(checkpoint_path):
+        return done
+
+    with open(checkpoint_path, "r") as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line of a crashed run might be incomplete
+                continue
+
+            done[entry["piece"]] = entry["offset"]
+
+    return done
+
+class PhraseCsvStream:
+    # Rows of finished pieces are appended to output_path.partial as they come, and their piece
+    # ids to output_path.checkpoint once the rows are on disk. finish sorts them into output_path.
+    def __init__(self, output_path, resume=False):
+        self.output_path = output_path
+        self.rows_path = output_path + ".partial"
+        self.checkpoint_path = output_path + ".checkpoint"
+
+        self.done = {}
+        if resume and os.path.isfile(self.rows_path):
+            self.done = load_checkpoint(self.checkpoint_path)
+
+        # Rows written after the last checkpoint belong to a piece that didn't finish
+        if len(self.done) > 0:
+            os.truncate(self.rows_path, max(self.done.values()))
+            self.rows_fp = open(self.rows_path, "a")
+            self.checkpoint_fp = open(self.checkpoint_path, "a")
+        else:
+            self.rows_fp = open(self.rows_path, "w")
+            self.checkpoint_fp = open(self.checkpoint_path, "w")
+
+        self.writer = csv.DictWriter(self.rows_fp, fieldnames=PHRASE_CSV_COLUMNS)
+
+    def __contains__(self, piece_id):
+        return piece_id in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def append(self, piece_id, rows):
+        self.writer.writerows(rows)
+        self.rows_fp.flush()
+        os.fsync(self.rows_fp.fileno())
+
+        offset = os.fstat(self.rows_fp.fileno()).st_size
+        self.checkpoint_fp.write(json.dumps({"piece": piece_id, "offset": offset}) + "\n")
+        self.checkpoint_fp.flush()
+
+        self.done[piece_id] = offset
+
+    def finish(self):
+        self.rows_fp.close()
+        self.checkpoint_fp.close()
+
+        sort_phrase_csv(self.rows_path, self.output_path)
+
+        os.remove(self.rows_path)
+        os.remove(self.checkpoint_path)
+
 if __name__ == "__main__":
     # Parse arguments
     parser = argparse.ArgumentParser(description='train_generative.py')
-    parser.add_argument('--annotations', type=str, required=True, help="Dir with annotation files.")
+    parser.add_argument('--annotations', type=str, required=True, help="Dir with annotation files or compiled annotation store.")
     opt = parser.parse_args()
 
-    age, gender, musicianship = parse_demographics(opt.annotations)
+    if is_annotation_store(opt.annotations):
+        age, gender, musicianship = parse_demographics(opt.annotations)
+    else:
+        pieces, demographics = ingest_annotations(opt.annotations)
+        age, gender, musicianship = demographics.frequencies()
 
     print(age)
     print(gender)
     print(musicianship)
+
+    if not is_annotation_store(opt.annotations):
+        print("Mean arousal variance by musicianship:")
+        print(demographics.crosstab("musicianship", "arousal_variance"))
@@ -1,10 +1,27 @@
+import os
+import sys
+import pickle
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+
 # External imports
+import matplotlib
+matplotlib.use("Agg")
+
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 # Local imports
 from cluster import *
 
+# Modules shared with the unlabelled scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+from tracing import span
+
 def plot_annotation(piece_annotations, y_axis="", subtitle=""):
     fig, axarr = plt.subplots(2, sharex=True, figsize=(15, 5))
     fig.suptitle(subtitle)
@@ -23,71 +40,122 @@ def plot_annotation(piece_annotations, y_axis="", subtitle=""):
     plt.clf()
     plt.close();
 
-def plot_cluster(series, clustering, best_cluster, y_axis="", subtitle="", filename="clustering.png"):
-    # Plot figure with subplots of different sizes
-    fig = plt.figure()
+class ClusterPlot:
+    def __init__(self, n_clusters):
+        # Figure is drawn straight to an Agg canvas, without pyplot's global state
+        self.fig = Figure()
+        FigureCanvasAgg(self.fig)
 
-    n_clusters = len(clustering)
+        grid = gridspec.GridSpec(3, n_clusters, figure=self.fig)
+        self.series_ax = self.fig.add_subplot(grid[0, :])
+        self.cluster_axs = [self.fig.add_subplot(grid[1, i]) for i in range(n_clusters)]
+        self.summary_ax = self.fig.add_subplot(grid[2, :])
 
-    ts_ax = plt.subplot2grid((3, n_clusters), (0, 0), colspan=n_clusters)
-    ts_ax.set_title("Annotation", fontsize=12)
+        self.series_ax.set_title("Annotation", fontsize=12)
+        for i, ax in enumerate(self.cluster_axs):
+            ax.set_title("Cluster " + str(i+1), fontsize=12)
 
-    plt.axis([0, len(series[0]), -1, 1])
-    plt.xticks(np.arange(0, len(series[0]), 5))
-    plt.xlabel('Measures')
-    plt.ylabel(y_axis)
+        # One line collection per axis is reused for every piece
+        self.colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        self.series_lines = self.add_lines(self.series_ax)
+        self.cluster_lines = [self.add_lines(ax) for ax in self.cluster_axs]
+        self.summary_line, = self.summary_ax.plot([], [], color=self.colors[0])
 
-    # large subplot
-    for x in series:
-        plt.plot(x)
+        for ax in self.axs():
+            ax.set_xlabel('Measures')
 
-    # small subplot 1
-    for i in range(len(clustering)):
-        ts_ax = plt.subplot2grid((3, n_clusters), (1, i), colspan=1)
-        ts_ax.set_title("Cluster " + str(i+1), fontsize=12)
+        self.layout_done = False
+
+    def axs(self):
+        return [self.series_ax] + self.cluster_axs + [self.summary_ax]
+
+    def add_lines(self, ax):
+        lines = LineCollection([])
+        ax.add_collection(lines)
+        return lines
+
+    def set_lines(self, lines, ax, series):
+        series = list(series)
+        lines.set_segments([np.column_stack([np.arange(len(x)), x]) for x in series])
+        lines.set_colors([self.colors[i % len(self.colors)] for i in range(len(series))])
 
         axis = 0
-        if len(clustering[i]) > 0:
-            axis = len(clustering[i][0])
+        if len(series) > 0:
+            axis = len(series[0])
 
-        plt.axis([0, axis, -1, 1])
-        plt.xticks(np.arange(0, axis, 5))
-        plt.xlabel('Measures')
-        plt.ylabel(y_axis)
-        for x in clustering[i]:
-            plt.plot(x)
+        # Always reset the limits, an empty cluster would keep the range of the previous piece
+        ax.set_xlim(0, axis)
+        ax.set_ylim(-1, 1)
+        ax.set_xticks(np.arange(0, axis, 5))
 
-    ts_ax = plt.subplot2grid((3, n_clusters), (2, 0), colspan=n_clusters)
-    ts_ax.set_title("Summary of the cluster " + str(best_cluster + 1) , fontsize=12)
+    def draw(self, series, clustering, best_cluster, y_axis, filename):
+        for ax in self.axs():
+            ax.set_ylabel(y_axis)
 
-    plt.axis([0, len(clustering[best_cluster][0]), -1, 1])
-    # plt.xticks(np.arange(0, len(clustering[h_ix][0]), 5))
-    plt.xlabel('Measures')
-    plt.ylabel(y_axis)
+        self.set_lines(self.series_lines, self.series_ax, series)
+        for i in range(len(clustering)):
+            self.set_lines(self.cluster_lines[i], self.cluster_axs[i], clustering[i])
 
-    plt.plot(np.mean(clustering[best_cluster], axis=0))
+        best_mean = np.mean(clustering[best_cluster], axis=0)
+        self.summary_ax.set_title("Summary of the cluster " + str(best_cluster + 1) , fontsize=12)
+        self.summary_line.set_data(np.arange(len(best_mean)), best_mean)
+        self.summary_ax.set_xlim(0, len(clustering[best_cluster][0]))
+        self.summary_ax.set_ylim(-1, 1)
 
-    # Plot splitting points
-    # plt.vlines(split_points, -1, 1, colors='r', linestyles='dashed')
+        # Labels never change size much between pieces, so lay them out only once.
+        # Detaching the layout engine afterwards also stops savefig from drawing twice.
+        if not self.layout_done:
+            self.fig.tight_layout()
+            self.fig.set_layout_engine("none")
+            self.layout_done = True
 
-    # fit subplots and save fig
-    fig.tight_layout()
-    fig.savefig(filename, format="png")
+        self.fig.savefig(filename, format="png")
 
-    fig.clf()
-    plt.clf()
-    plt.close()
+# Figures reused by this process, one per number of clusters
+cluster_plots = {}
+
+def plot_cluster(series, clustering, best_cluster, y_axis="", subtitle="", filename="clustering.png"):
+    n_clusters = len(clustering)
+    if n_clusters not in cluster_plots:
+        cluster_plots[n_clusters] = ClusterPlot(n_clusters)
+
+    cluster_plots[n_clusters].draw(series, clustering, best_cluster, y_axis, filename)
+
+    return filename
+
+def plot_job_piece(plot_job):
+    # Plots are named after the midi file of their piece
+    return os.path.splitext(os.path.basename(plot_job[-1]))[0]
 
-    #
-    # fig = plt.figure()
-    # ax1 = plt.subplot2grid((3,2), (0, 0), colspan=2)
-    # ax2 = plt.subplot2grid((3,2), (1, 0), colspan=1)
-    # ax3 = plt.subplot2grid((3,2), (1, 1), colspan=1)
-    # ax4 = plt.subplot2grid((3,2), (2, 0), colspan=2)
-    #
-    # fig.tight_layout()
-    #
-    # fig.savefig(filename, format="png")
+def render_plot_job(plot_job):
+    with span("plot", plot_job_piece(plot_job)):
+        return plot_cluster(*plot_job)
+
+def save_plot_job(plot_job):
+    # Lazy plots keep the cluster data next to where the png would go
+    job_path = os.path.splitext(plot_job[-1])[0] + ".pkl"
+    with span("plot", plot_job_piece(plot_job)):
+        with open(job_path, "wb") as fp:
+            pickle.dump(plot_job, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return job_path
+
+def render_lazy_plots(plots_path, workers=1):
+    plot_jobs = []
+    for root, dirs, files in os.walk(plots_path):
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1] != ".pkl":
+                continue
+
+            with open(os.path.join(root, filename), "rb") as fp:
+                plot_job = pickle.load(fp)
+
+            if not os.path.isfile(plot_job[-1]):
+                plot_jobs.append(plot_job)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for filename in executor.map(render_plot_job, plot_jobs):
+            print("Plotted...", filename)
 
 def plot_means(means, filename, y_axis="", title="", color=(0,0,1,1)):
     fig = plt.figure(figsize=(7,2))
@@ -115,3 +183,12 @@ def plot_means(means, filename, y_axis="", title="", color=(0,0,1,1)):
     fig.clf()
     plt.clf()
     plt.close()
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='plot.py')
+    parser.add_argument('--plots', type=str, required=True, help="Plots path with lazy cluster data.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes.")
+    opt = parser.parse_args()
+
+    render_lazy_plots(opt.plots, opt.workers)
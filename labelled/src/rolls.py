@@ -0,0 +1,167 @@
+import os
+import csv
+import argparse
+import functools
+import pretty_midi
+import numpy as np
+
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+from store   import write_store, read_store
+from archive import PhraseArchive
+
+# Default piano roll frame rate, in frames per second
+ROLL_FS = 100
+
+def sparse_piano_roll(midi_data, fs=ROLL_FS):
+    # Piano roll as CSR rows of frames: per frame counts, pitches and velocities of the active notes
+    roll = midi_data.get_piano_roll(fs=fs).T
+
+    frames, pitches = np.nonzero(roll)
+    counts = np.bincount(frames, minlength=len(roll))
+
+    # Overlapping notes sum their velocities, which can go over 127
+    return counts, pitches.astype(np.uint8), roll[frames, pitches].astype(np.uint16)
+
+@functools.lru_cache(maxsize=None)
+def open_archive(zip_path):
+    # Each process maps a zip once
+    return PhraseArchive(zip_path)
+
+class MidiResolver:
+    # Finds the midi of a csv row in a phrases zip, a dir of midi files or relative to a root dir
+    def __init__(self, root=".", midi_dir=None, zip_path=None):
+        self.root = root
+        self.midi_dir = midi_dir
+        self.zip_path = zip_path
+
+    def locate(self, midi_path):
+        # Path of the file holding the midi: the zip, a file in midi_dir or a file under root
+        if self.zip_path is not None and midi_path in open_archive(self.zip_path):
+            return self.zip_path
+
+        if self.midi_dir is not None:
+            dir_path = os.path.join(self.midi_dir, os.path.basename(midi_path))
+            if os.path.isfile(dir_path):
+                return dir_path
+
+        return os.path.join(self.root, midi_path)
+
+    def read_bytes(self, midi_path):
+        midi_location = self.locate(midi_path)
+        if midi_location == self.zip_path:
+            return bytes(open_archive(self.zip_path).read(midi_path))
+
+        with open(midi_location, "rb") as fp:
+            return fp.read()
+
+    def __call__(self, midi_path):
+        midi_location = self.locate(midi_path)
+        if midi_location == self.zip_path:
+            return open_archive(self.zip_path).read_midi(midi_path)
+
+        return pretty_midi.PrettyMIDI(midi_location)
+
+def compute_piano_roll(midi_path, read_midi, fs=ROLL_FS):
+    try:
+        midi_data = read_midi(midi_path)
+    except Exception as e:
+        print("----", "Could not read midi file.", midi_path, e)
+        return None
+
+    print("Rolling...", midi_path)
+    return sparse_piano_roll(midi_data, fs)
+
+def build_piano_rolls(csv_paths, rolls_path, read_midi, fs=ROLL_FS, workers=1):
+    rows = [row for csv_path in csv_paths for row in csv.DictReader(open(csv_path, "r"))]
+    midi_paths = [row["midi"] for row in rows]
+
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        rolls = executor.map(compute_piano_roll, midi_paths, repeat(read_midi), repeat(fs), chunksize=8)
+    else:
+        rolls = map(compute_piano_roll, midi_paths, repeat(read_midi), repeat(fs))
+
+    ids, midis = [], []
+    counts, pitches, velocities = [], [], []
+    for row, roll in zip(rows, rolls):
+        if roll is None:
+            continue
+
+        ids.append(int(row["id"]))
+        midis.append(row["midi"])
+
+        counts.append(roll[0])
+        pitches.append(roll[1])
+        velocities.append(roll[2])
+
+    if executor is not None:
+        executor.shutdown()
+
+    # Frames of all pieces are rows of one CSR matrix, pieces are ranges of rows
+    columns = {"frame_offsets": np.cumsum([0] + [len(c) for c in counts]).astype(np.int64),
+                      "indptr": np.cumsum(np.concatenate([[0]] + counts)).astype(np.int64),
+                     "indices": np.concatenate([np.zeros(0, dtype=np.uint8)] + pitches),
+                        "data": np.concatenate([np.zeros(0, dtype=np.uint16)] + velocities),
+                         "ids": np.array(ids, dtype=np.int64)}
+
+    write_store(rolls_path, columns, {"kind": "piano_rolls", "fs": fs, "midi": midis})
+
+class PianoRolls:
+    def __init__(self, rolls_path):
+        self.buffer, self.header, self.columns = read_store(rolls_path)
+
+        if self.header.get("kind") != "piano_rolls":
+            raise ValueError(rolls_path + " is not a piano roll container.")
+
+        self.fs = self.header["fs"]
+        self.midi = self.header["midi"]
+        self.ids = self.columns["ids"]
+        self.frame_offsets = self.columns["frame_offsets"]
+
+    def __len__(self):
+        return len(self.frame_offsets) - 1
+
+    def __getitem__(self, i):
+        return self.roll(i)
+
+    def frames(self, i):
+        return int(self.frame_offsets[i + 1] - self.frame_offsets[i])
+
+    def roll(self, i, start=0, end=None):
+        # Densify only frames [start, end) of piece i, shaped (128, frames) like get_piano_roll
+        n_frames = self.frames(i)
+        if end is None or end > n_frames:
+            end = n_frames
+        start = min(start, end)
+
+        first_row = self.frame_offsets[i] + start
+        indptr = self.columns["indptr"][first_row:first_row + end - start + 1]
+
+        indices = self.columns["indices"][indptr[0]:indptr[-1]]
+        data = self.columns["data"][indptr[0]:indptr[-1]]
+        frames = np.repeat(np.arange(end - start), np.diff(indptr))
+
+        roll = np.zeros((128, end - start))
+        roll[indices, frames] = data
+        return roll
+
+    def window(self, i, start_time, end_time):
+        # Same as roll, with bounds in seconds
+        return self.roll(i, int(start_time * self.fs), int(np.ceil(end_time * self.fs)))
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='rolls.py')
+    parser.add_argument('--csv', type=str, nargs='+', required=True, help="Dataset csvs, like vgmidi_labelled.csv and vgmidi_unlabelled.csv.")
+    parser.add_argument('--out', type=str, required=True, help="Piano roll container output path.")
+    parser.add_argument('--root', type=str, default=".", help="Dir the csv midi paths are relative to.")
+    parser.add_argument('--midi', type=str, default=None, help="Dir to look midi files up by name.")
+    parser.add_argument('--zip', type=str, default=None, help="Phrases zip to look midi files up in.")
+    parser.add_argument('--fs', type=int, default=ROLL_FS, help="Piano roll frames per second.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes.")
+    opt = parser.parse_args()
+
+    build_piano_rolls(opt.csv, opt.out, MidiResolver(opt.root, opt.midi, opt.zip), opt.fs, opt.workers)
@@ -1,59 +1,99 @@
+import io
 import os
+import sys
 import hashlib
 import pretty_midi
 import numpy as np
 
+from notes import midi_to_notes, notes_to_midi, shift_notes
+
+# Modules shared with the unlabelled scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+from tracing import span, count
+
 MIN_PIECE_ID = 8000
 
-def discretize_emotion(emotion, emotion_threshold, context):
-    d_emotion = 0
+# Looked up once, the lookup normalizes every instrument name
+PIANO_PROGRAM = pretty_midi.instrument_name_to_program('Acoustic Grand Piano')
 
-    if emotion < -emotion_threshold:
-        d_emotion = -1
-    elif emotion > emotion_threshold:
-        d_emotion = 1
+def pad_series(series, fill_value=np.nan):
+    # Stack series of different lengths into a (n_series, max_length) matrix
+    lengths = np.array([len(x) for x in series], dtype=np.int64)
 
-    # Check context to solve ambiguity
-    if d_emotion == 0:
-        if len(context) > 0:
-            d_emotion = max(set(context), key=context.count)
-        else:
-            if emotion < 0:
-                d_emotion = -1
-            elif emotion > 0:
-                d_emotion = 1
+    padded = np.full((len(series), lengths.max(initial=0)), fill_value, dtype=np.float64)
+    for i, x in enumerate(series):
+        padded[i, :lengths[i]] = x
 
-    return d_emotion
+    return padded, lengths
 
-def emotion(v, a, emotion_threshold, v_context=[], a_context=[]):
-    v = discretize_emotion(v, emotion_threshold, v_context)
-    a = discretize_emotion(a, emotion_threshold/2, a_context)
-    return np.array([v, a])
+def discretize_emotions(emotions, emotion_threshold):
+    # Discretize a (n_pieces, n_measures) matrix of emotions to -1/1. NaNs are padding.
+    emotions = np.atleast_2d(np.asarray(emotions, dtype=np.float64))
+    valid = ~np.isnan(emotions)
 
-def split_annotation_by_emotion(valence, arousal, ambiguity_threshold=0.0):
-    last_emotion = None
+    d_emotions = np.zeros(emotions.shape, dtype=np.int64)
+    d_emotions[emotions < -emotion_threshold] = -1
+    d_emotions[emotions > emotion_threshold] = 1
 
-    v_context = []
-    a_context = []
+    ambiguous = (d_emotions == 0) & valid
+    if not ambiguous.any():
+        return d_emotions
 
-    ix, chunks = -1, []
-    for v,a in zip(valence, arousal):
-        # Create emotion as numpy array
-        current_emotion = emotion(v, a, ambiguity_threshold, v_context, a_context)
+    # Ambiguous measures take the most frequent previous emotion of their piece (1 on ties).
+    # Without any previous emotion, they take the sign of the emotion itself.
+    signs = np.sign(np.where(valid, emotions, 0)).astype(np.int64)
 
-        if (current_emotion != last_emotion).any():
-            chunks.append([current_emotion])
-            ix += 1
-        else:
-            chunks[ix].append(current_emotion)
+    context_balance = np.zeros(len(emotions), dtype=np.int64)
+    has_context = np.zeros(len(emotions), dtype=bool)
+
+    first_ambiguous = np.argmax(ambiguous.any(axis=0))
+    if first_ambiguous > 0:
+        context_balance += d_emotions[:, :first_ambiguous].sum(axis=1)
+        has_context |= (d_emotions[:, :first_ambiguous] != 0).any(axis=1)
+
+    for j in range(first_ambiguous, emotions.shape[1]):
+        majority = np.where(context_balance >= 0, 1, -1)
+        resolved = np.where(has_context, majority, signs[:, j])
+
+        d_emotion = np.where(ambiguous[:, j], resolved, d_emotions[:, j])
+        d_emotions[:, j] = d_emotion
+
+        context_balance += d_emotion
+        has_context |= d_emotion != 0
+
+    return d_emotions
 
-        if current_emotion[0] != 0:
-            v_context.append(current_emotion[0])
+def emotion_chunk_bounds(emotions):
+    # Return start and end indices of the runs of equal (valence, arousal) rows
+    if len(emotions) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
 
-        if current_emotion[1] != 0:
-            a_context.append(current_emotion[1])
+    changes = np.nonzero(np.any(emotions[1:] != emotions[:-1], axis=1))[0] + 1
 
-        last_emotion = current_emotion
+    starts = np.concatenate([[0], changes])
+    ends = np.concatenate([changes, [len(emotions)]])
+    return starts, ends
+
+def discretize_annotations(valence, arousal, ambiguity_threshold=0.0):
+    # Discretize the medians of several pieces at once. Returns one (n_measures, 2) array per piece.
+    valence, valence_lengths = pad_series(valence)
+    arousal, arousal_lengths = pad_series(arousal)
+
+    d_valence = discretize_emotions(valence, ambiguity_threshold)
+    d_arousal = discretize_emotions(arousal, ambiguity_threshold/2)
+
+    emotions = []
+    for i in range(len(valence)):
+        emotions.append(np.stack([d_valence[i, :valence_lengths[i]], d_arousal[i, :arousal_lengths[i]]], axis=1))
+
+    return emotions
+
+def split_annotation_by_emotion(valence, arousal, ambiguity_threshold=0.0):
+    emotions = discretize_annotations([valence], [arousal], ambiguity_threshold)[0]
+
+    chunks = []
+    for start, end in zip(*emotion_chunk_bounds(emotions)):
+        chunks.append(list(emotions[start:end]))
 
     return chunks
 
@@ -65,79 +105,107 @@ def slice_chunk_with_emotion(chunk, split_size):
 
     return slices
 
-def slice_midi(midi_data, start, end):
-    notes = []
+def index_midi_notes(midi_data):
+    notes = midi_to_notes(midi_data)
 
-    for instrument in midi_data.instruments:
-        if not instrument.is_drum:
-            for note in instrument.notes:
-                if note.start >= start and note.start < end:
-                    note.start -= start
-                    note.end -= start
-                    notes.append(note)
+    # Sort note onsets once so slices can be found with a binary search
+    order = np.argsort(notes["start"], kind="stable")
 
-    if len(notes) > 0:
-        return create_midi_slice(notes, midi_data.resolution)
+    return notes, notes["start"][order], order
 
-    return None
+def slice_midi_at(note_index, starts, ends, resolution):
+    notes, sorted_onsets, order = note_index
 
-def create_midi_slice(notes, resolution):
-    # Create a PrettyMIDI object
-    midi = pretty_midi.PrettyMIDI(resolution=resolution)
+    # Notes of slice i are the ones with starts[i] <= note.start < ends[i]
+    lo = np.searchsorted(sorted_onsets, starts, side="left")
+    hi = np.searchsorted(sorted_onsets, ends, side="left")
+
+    slices = []
+    for start, l, h in zip(starts, lo, hi):
+        if h <= l:
+            slices.append(None)
+            continue
+
+        # Keep the original instrument/note order. Fancy indexing copies, so the piece isn't shifted.
+        sliced_notes = shift_notes(notes[np.sort(order[l:h])], -float(start))
+
+        slices.append(create_midi_slice(sliced_notes, resolution))
+
+    return slices
 
-    # Create an Instrument instance for a piano instrument
-    piano_program = pretty_midi.instrument_name_to_program('Acoustic Grand Piano')
-    piano = pretty_midi.Instrument(program=piano_program)
+def slice_midi(midi_data, start, end):
+    note_index = index_midi_notes(midi_data)
+    return slice_midi_at(note_index, [start], [end], midi_data.resolution)[0]
 
-    # Add notes
-    for n in notes:
-        piano.notes.append(n)
-    midi.instruments.append(piano)
+def create_midi_slice(notes, resolution):
+    # Every note of the slice goes to a single piano instrument
+    return notes_to_midi(notes, resolution, PIANO_PROGRAM)
 
-    return midi
+def serialize_midi(midi_data):
+    # Write midi to an in-memory buffer instead of a file
+    buffer = io.BytesIO()
+    midi_data.write(buffer)
+    return buffer.getvalue()
+
+def write_midi_phrases(phrase_files):
+    for phrase_path, phrase_bytes in phrase_files:
+        with open(phrase_path, "wb") as midi_file:
+            midi_file.write(phrase_bytes)
 
 def split_midi(piece_id, midi_path, labeled_splits, measure_length, splits_path):
-    # Load midi data
-    midi_data = pretty_midi.PrettyMIDI(midi_path)
+    annotated_data, phrase_files = split_midi_phrases(piece_id, midi_path, labeled_splits, measure_length, splits_path)
 
+    # Only unique phrases are written, all at once after the piece is split
+    write_midi_phrases(phrase_files)
+
+    return annotated_data
+
+def split_midi_phrases(piece_id, midi_path, labeled_splits, measure_length, splits_path):
+    # Same as split_midi, but returns the (path, bytes) of the phrases instead of writing them
     # Parse midi metadata from name
     midi_root, midi_ext = os.path.splitext(os.path.basename(midi_path))
+
+    # Load midi data
+    with span("load_midi", midi_root):
+        midi_data = pretty_midi.PrettyMIDI(midi_path)
+
     id      = MIN_PIECE_ID + int(piece_id.split("_")[-1])
     series  = midi_root.split("_")[0]
     console = midi_root.split("_")[1]
     game    = midi_root.split("_")[2]
     piece   = midi_root.split("_")[3]
 
-    # Dictionary to store the midi slices
+    # Dictionary to store the midi slices and list of (path, bytes) to write
     annotated_data = {}
+    phrase_files = []
 
-    split_init = 0
-    split_count = 0
-    for split in labeled_splits:
-        split_size = len(split)
+    # Get chunk boundaries in seconds and slice the midi at all of them in one pass
+    split_sizes = [len(split) for split in labeled_splits]
+    split_bounds = np.cumsum([0] + split_sizes) * measure_length
 
-        # Get midi for this entire chunk
-        split_start = (split_init * measure_length)
-        split_end   = (split_init + split_size) * measure_length
+    note_index = index_midi_notes(midi_data)
+    split_midis = slice_midi_at(note_index, split_bounds[:-1], split_bounds[1:], midi_data.resolution)
 
-        split_midi_data = slice_midi(midi_data, split_start, split_end)
+    split_count = 0
+    for split, split_midi_data in zip(labeled_splits, split_midis):
         if split_midi_data is None:
             print("Empty split!")
+            count("empty_splits")
             continue
 
         # Get valence of arousal of this chunk
         split_valence = split[0][0]
         split_arousal = split[0][1]
 
-        # Save midi chunk
-        split_name = os.path.join(splits_path, midi_root + "_" + str(split_count) + ".mid")
-        split_midi_data.write(split_name)
+        # Serialize midi chunk and hash it before anything touches the disk
+        split_bytes = serialize_midi(split_midi_data)
+        ch_key = hashlib.md5(split_bytes).hexdigest()
 
         # Add split to the dataset
-        with open(split_name, "rb") as midi_file:
-            ch_key = hashlib.md5(midi_file.read()).hexdigest()
-
         if ch_key not in annotated_data:
+            split_name = os.path.join(splits_path, midi_root + "_" + str(split_count) + ".mid")
+            phrase_files.append((split_name, split_bytes))
+
             annotated_data[ch_key] = {"id": id,
                                   "series": series,
                                  "console": console,
@@ -148,9 +216,9 @@ def split_midi(piece_id, midi_path, labeled_splits, measure_length, splits_path)
                                  "arousal": split_arousal}
 
             split_count += 1
+            count("phrases")
         else:
             print(ch_key, "is repeated")
+            count("duplicate_phrases")
 
-        split_init += split_size
-
-    return list(annotated_data.values())
+    return list(annotated_data.values()), phrase_files
@@ -0,0 +1,344 @@
+import os
+import json
+import argparse
+import numpy as np
+
+# Compiled annotation store layout:
+#   magic (8 bytes) | header length (uint64) | json header | aligned column blocks
+# The header holds piece metadata, demographic categories and, for every column,
+# its dtype, shape and byte offset, so columns can be viewed straight from a mmap.
+STORE_MAGIC = b"VGMIDIAN"
+STORE_VERSION = 1
+STORE_ALIGNMENT = 64
+
+# Number of characters read at a time when streaming json
+JSON_CHUNK_SIZE = 1 << 16
+
+DEMOGRAPHIC_COLUMNS = ["age", "gender", "musicianship"]
+
+def align(offset, alignment=STORE_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+class JSONStream:
+    def __init__(self, fp, chunk_size=JSON_CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def refill(self):
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\n\r":
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ""
+            self.refill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected " + char + " in json stream.")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+
+        # Grow the buffer until it holds the whole value. A value must be followed by a
+        # delimiter, otherwise it might continue in the next chunk (e.g. "1." of "1.5").
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if (end < len(self.buffer) and self.buffer[end] in ",:]} \t\n\r") or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.refill()
+
+def iter_json_members(fp, chunk_size=JSON_CHUNK_SIZE):
+    # Yield (key, member_key, member) for every member of the top level objects,
+    # decoding one member at a time instead of the whole file
+    stream = JSONStream(fp, chunk_size)
+
+    stream.expect("{")
+    while stream.peek() != "}":
+        key = stream.value()
+        stream.expect(":")
+
+        if stream.peek() == "{":
+            stream.expect("{")
+            while stream.peek() != "}":
+                member_key = stream.value()
+                stream.expect(":")
+                yield key, member_key, stream.value()
+
+                if stream.peek() == ",":
+                    stream.expect(",")
+            stream.expect("}")
+        else:
+            yield key, None, stream.value()
+
+        if stream.peek() == ",":
+            stream.expect(",")
+    stream.expect("}")
+
+class Demographics:
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories
+
+    def frequencies(self):
+        frequencies = []
+        for name in DEMOGRAPHIC_COLUMNS:
+            codes = self.columns[name]
+            counts = np.bincount(codes, minlength=len(self.categories[name]))
+            frequencies.append({c: int(counts[i])/len(codes) for i, c in enumerate(self.categories[name])})
+
+        return tuple(frequencies)
+
+    def crosstab(self, by, value):
+        # Mean of a numeric column for every category of a demographic column
+        codes = self.columns[by]
+        values = self.columns[value]
+
+        sums = np.bincount(codes, weights=values, minlength=len(self.categories[by]))
+        counts = np.bincount(codes, minlength=len(self.categories[by]))
+        return {c: float(sums[i]/counts[i]) for i, c in enumerate(self.categories[by]) if counts[i] > 0}
+
+def ingest_annotations(annotations_path):
+    # Decode every annotation round once, returning the pieces together with a table
+    # of one row per annotation for the demographics. Annotations of ids missing from
+    # the pieces of their round only get a row, with piece -1.
+    joint_pieces = {}
+
+    categories = {name: {} for name in DEMOGRAPHIC_COLUMNS}
+    columns = {name: [] for name in DEMOGRAPHIC_COLUMNS + ["piece", "valence_variance", "arousal_variance"]}
+
+    for filename in os.listdir(annotations_path):
+        if os.path.splitext(filename)[1] != ".json":
+            continue
+
+        round_pieces = {}
+        round_annotations = {}
+
+        with open(os.path.join(annotations_path, filename), "r") as fp:
+            for key, member_id, member in iter_json_members(fp):
+                if key == "pieces":
+                    round_pieces[member_id] = member
+
+                elif key == "annotations":
+                    for name in DEMOGRAPHIC_COLUMNS:
+                        if member[name] not in categories[name]:
+                            categories[name][member[name]] = len(categories[name])
+                        columns[name].append(categories[name][member[name]])
+
+                    columns["valence_variance"].append(np.var(np.array(member["valence"], dtype=np.float64)))
+                    columns["arousal_variance"].append(np.var(np.array(member["arousal"], dtype=np.float64)))
+                    columns["piece"].append(-1)
+
+                    # Pieces may only be known at the end of the round, so keep every annotation for now
+                    piece_id = member_id.split("_")[0]
+                    if piece_id not in round_annotations:
+                        round_annotations[piece_id] = []
+                    round_annotations[piece_id].append((len(columns["piece"]) - 1, member["valence"], member["arousal"]))
+
+        for piece_id, annotations in round_annotations.items():
+            if piece_id not in round_pieces:
+                continue
+
+            joint_piece_ix = len(joint_pieces)
+            joint_pieces["piece_" + str(joint_piece_ix)] = {"name": round_pieces[piece_id]["name"],
+                                                            "midi": round_pieces[piece_id]["midi"],
+                                                        "measures": round_pieces[piece_id]["measures"],
+                                                        "duration": round_pieces[piece_id]["duration"],
+                                                         "arousal": [a[2] for a in annotations],
+                                                         "valence": [a[1] for a in annotations]}
+
+            for row, valence, arousal in annotations:
+                columns["piece"][row] = joint_piece_ix
+
+    columns = {name: np.array(column) for name, column in columns.items()}
+    categories = {name: list(codes.keys()) for name, codes in categories.items()}
+
+    return joint_pieces, Demographics(columns, categories)
+
+def compile_annotation_store(annotations_path, store_path, dtype=np.float32):
+    joint_pieces, demographics = ingest_annotations(annotations_path)
+
+    pieces = []
+    for piece_id, piece in joint_pieces.items():
+        pieces.append({"id": piece_id,
+                     "name": piece["name"],
+                     "midi": piece["midi"],
+                 "measures": piece["measures"],
+                 "duration": piece["duration"]})
+
+    columns = {}
+    columns["piece_offsets"] = np.cumsum([0] + [len(p["valence"]) for p in joint_pieces.values()]).astype(np.int64)
+
+    for dimension in ["valence", "arousal"]:
+        values = [v for p in joint_pieces.values() for v in p[dimension]]
+        columns[dimension + "_offsets"] = np.cumsum([0] + [len(v) for v in values]).astype(np.int64)
+        columns[dimension] = np.array([x for v in values for x in v], dtype=dtype)
+
+    # Piece annotations come first, grouped by piece, so a piece is a contiguous row range.
+    # Annotations that aren't part of any piece still count for the demographics, so they go last.
+    piece = demographics.columns["piece"]
+    rows = np.argsort(np.where(piece < 0, len(pieces), piece), kind="stable")
+
+    # Demographics are stored as categorical codes, with categories in order of appearance
+    for name in DEMOGRAPHIC_COLUMNS:
+        columns[name] = demographics.columns[name][rows].astype(np.uint16)
+
+    write_store(store_path, columns, {"pieces": pieces, "categories": demographics.categories})
+
+def write_store(store_path, columns, metadata):
+    header = dict(metadata)
+    header["version"] = STORE_VERSION
+    header["columns"] = {}
+
+    # Compute the offsets with a placeholder header, then grow it until offsets are stable
+    data_start = 0
+    while True:
+        offset = data_start
+        for name, column in columns.items():
+            header["columns"][name] = {"dtype": column.dtype.str, "shape": list(column.shape), "offset": offset}
+            offset = align(offset + column.nbytes)
+
+        header_bytes = json.dumps(header).encode("utf-8")
+        header_end = len(STORE_MAGIC) + 8 + len(header_bytes)
+        if align(header_end) == data_start:
+            break
+        data_start = align(header_end)
+
+    # Write to a temp file first so a crash never leaves a truncated store behind
+    tmp_path = store_path + ".tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(STORE_MAGIC)
+        fp.write(np.uint64(len(header_bytes)).tobytes())
+        fp.write(header_bytes)
+
+        for name, column in columns.items():
+            fp.write(b"\0" * (header["columns"][name]["offset"] - fp.tell()))
+            fp.write(np.ascontiguousarray(column).tobytes())
+
+    os.replace(tmp_path, store_path)
+
+def is_annotation_store(path):
+    if not os.path.isfile(path):
+        return False
+
+    with open(path, "rb") as fp:
+        return fp.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+def read_store(store_path):
+    buffer = np.memmap(store_path, dtype=np.uint8, mode="r")
+
+    if bytes(buffer[:len(STORE_MAGIC)]) != STORE_MAGIC:
+        raise ValueError(store_path + " is not a compiled store.")
+
+    header_start = len(STORE_MAGIC) + 8
+    header_len = int(buffer[len(STORE_MAGIC):header_start].view(np.uint64)[0])
+    header = json.loads(bytes(buffer[header_start:header_start + header_len]))
+
+    if header["version"] != STORE_VERSION:
+        raise ValueError("Unsupported store version " + str(header["version"]))
+
+    # Columns are zero-copy views into the memory map
+    columns = {}
+    for name, column in header["columns"].items():
+        dtype = np.dtype(column["dtype"])
+        count = int(np.prod(column["shape"]))
+        start = column["offset"]
+        columns[name] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(column["shape"])
+
+    return buffer, header, columns
+
+class AnnotationStore:
+    def __init__(self, store_path):
+        self.buffer, self.header, self.columns = read_store(store_path)
+
+        # Other data, like token shards, is written in the same format
+        if self.header.get("kind", "annotations") != "annotations":
+            raise ValueError(store_path + " is not a compiled annotation store.")
+
+        self.pieces = self.header["pieces"]
+        self.categories = self.header["categories"]
+        self.piece_index = {p["id"]: i for i, p in enumerate(self.pieces)}
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __iter__(self):
+        return iter(self.piece_index)
+
+    def __contains__(self, piece_id):
+        return piece_id in self.piece_index
+
+    def __getitem__(self, piece_id):
+        return self.piece(piece_id)
+
+    def keys(self):
+        return self.piece_index.keys()
+
+    def items(self):
+        for piece_id in self.piece_index:
+            yield piece_id, self.piece(piece_id)
+
+    def values(self):
+        for piece_id in self.piece_index:
+            yield self.piece(piece_id)
+
+    def annotation_range(self, piece_id):
+        i = self.piece_index[piece_id]
+        piece_offsets = self.columns["piece_offsets"]
+        return piece_offsets[i], piece_offsets[i + 1]
+
+    def dimension(self, piece_id, dimension_name):
+        start, end = self.annotation_range(piece_id)
+
+        values = self.columns[dimension_name]
+        offsets = self.columns[dimension_name + "_offsets"]
+        return [values[offsets[j]:offsets[j + 1]] for j in range(start, end)]
+
+    def piece(self, piece_id):
+        piece = dict(self.pieces[self.piece_index[piece_id]])
+        del piece["id"]
+
+        piece["arousal"] = self.dimension(piece_id, "arousal")
+        piece["valence"] = self.dimension(piece_id, "valence")
+        return piece
+
+    def demographic(self, name):
+        return self.columns[name], self.categories[name]
+
+    def demographics(self):
+        frequencies = []
+        for name in DEMOGRAPHIC_COLUMNS:
+            codes, categories = self.demographic(name)
+            counts = np.bincount(codes, minlength=len(categories))
+            frequencies.append({c: int(counts[i])/len(codes) for i, c in enumerate(categories)})
+
+        return tuple(frequencies)
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='store.py')
+    parser.add_argument('--annotations', type=str, required=True, help="Dir with annotation files.")
+    parser.add_argument('--out', type=str, required=True, help="Compiled annotation store path.")
+    opt = parser.parse_args()
+
+    compile_annotation_store(opt.annotations, opt.out)
@@ -0,0 +1,90 @@
+import csv
+import argparse
+import numpy as np
+
+from parse   import *
+from split   import *
+from cluster import *
+
+# Valence-arousal quadrants of the circumplex model
+QUADRANTS = {(1, 1): "q1", (-1, 1): "q2", (-1, -1): "q3", (1, -1): "q4"}
+
+def cluster_medians(pieces, dimension_name, method="sign"):
+    data = [parse_emotion_dimension(piece, dimension_name) for piece in pieces.values()]
+
+    # Cluster all pieces at once and find the medians of the best clusters
+    medians = []
+    for clustering, best_cluster in cluster_annotations_batch(data, method):
+        medians.append(np.mean(clustering[best_cluster], axis=0))
+
+    return medians
+
+def sweep_thresholds(pieces, thresholds, method="sign"):
+    # Phrase lengths are given in measures. Phrases are counted before midi dedup.
+    # Cluster every piece only once, then evaluate all thresholds over the same medians
+    valence_medians = cluster_medians(pieces, "valence", method)
+    arousal_medians = cluster_medians(pieces, "arousal", method)
+
+    report = []
+    for threshold in thresholds:
+        phrase_lengths = []
+        quadrants = {q: 0 for q in QUADRANTS.values()}
+        quadrants["none"] = 0
+
+        for emotions in discretize_annotations(valence_medians, arousal_medians, threshold):
+            starts, ends = emotion_chunk_bounds(emotions)
+            phrase_lengths.append(ends - starts)
+
+            for start in starts:
+                quadrant = QUADRANTS.get(tuple(emotions[start]), "none")
+                quadrants[quadrant] += 1
+
+        phrase_lengths = np.concatenate(phrase_lengths)
+
+        row = {"threshold": threshold,
+                 "phrases": len(phrase_lengths),
+             "mean_length": np.mean(phrase_lengths),
+           "median_length": np.median(phrase_lengths),
+              "min_length": np.min(phrase_lengths),
+              "max_length": np.max(phrase_lengths)}
+
+        # Quadrant balance as the fraction of phrases in each quadrant
+        for quadrant, count in quadrants.items():
+            row[quadrant] = count/len(phrase_lengths)
+
+        report.append(row)
+
+    return report
+
+def print_sweep_report(report):
+    columns = list(report[0].keys())
+    print(" ".join("{:>13}".format(c) for c in columns))
+
+    for row in report:
+        print(" ".join("{:>13.3f}".format(row[c]) for c in columns))
+
+def persist_sweep_report(report, output_path):
+    with open(output_path, mode='w') as fp:
+        fp_writer = csv.DictWriter(fp, fieldnames=list(report[0].keys()))
+        fp_writer.writeheader()
+
+        for row in report:
+            fp_writer.writerow(row)
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='sweep.py')
+    parser.add_argument('--annotations', type=str, required=True, help="Dir with annotation files or compiled annotation store.")
+    parser.add_argument('--at', type=float, nargs='+', default=[round(t, 3) for t in np.arange(0.0, 0.31, 0.025)], help="Ambiguity Thresholds to evaluate.")
+    parser.add_argument('--clustering', type=str, default="sign", choices=["sign", "kmeans"], help="Annotation clustering method.")
+    parser.add_argument('--out', type=str, default=None, help="Path to save the sweep report as csv.")
+    opt = parser.parse_args()
+
+    # Parse music annotaion into a dict of pieces
+    pieces = parse_annotation(opt.annotations)
+
+    report = sweep_thresholds(pieces, opt.at, opt.clustering)
+    print_sweep_report(report)
+
+    if opt.out is not None:
+        persist_sweep_report(report, opt.out)
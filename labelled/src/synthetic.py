@@ -0,0 +1,143 @@
+import os
+import json
+import argparse
+import pretty_midi
+import numpy as np
+
+# Beats per measure and tempo of the generated pieces
+BEATS_PER_MEASURE = 4
+TEMPO = 120
+
+# Pitch range of the generated notes
+MIN_PITCH = 48
+MAX_PITCH = 84
+
+# Fraction of annotators that are noisy or annotate a different number of measures,
+# so the filters of parse_emotion_dimension have something to remove
+NOISY_ANNOTATORS = 0.1
+SHORT_ANNOTATORS = 0.05
+
+AGES = ["18-20", "21-25", "26-30", "31-35", "36-40", "41+"]
+GENDERS = ["Male", "Female", "Other"]
+COUNTRIES = ["Brazil", "Canada", "India", "United States", "United Kingdom"]
+
+def measure_length():
+    return BEATS_PER_MEASURE * 60/TEMPO
+
+def midi_name(i):
+    # Names split in the 4 fields split_midi reads: series, console, game and piece
+    return "Series{}_Console{}_Game{}_Piece{}.mid".format(i % 7, i % 3, i, i)
+
+def emotion_curve(rng, n_measures):
+    # A few sections of constant emotion, so pieces split in several chunks. Levels stay
+    # small enough for the annotations to pass the variance filter of parse_emotion_dimension.
+    n_sections = min(1 + rng.poisson(2), n_measures)
+    bounds = np.sort(rng.choice(np.arange(1, n_measures), n_sections - 1, replace=False))
+    levels = rng.uniform(-0.3, 0.3, n_sections)
+    return np.repeat(levels, np.diff(np.concatenate([[0], bounds, [n_measures]])))
+
+def annotate(rng, curve):
+    noise = 0.05
+    if rng.rand() < NOISY_ANNOTATORS:
+        noise = 0.6
+
+    annotation = np.clip(curve + rng.normal(0, noise, len(curve)), -1, 1)
+    if rng.rand() < SHORT_ANNOTATORS:
+        annotation = annotation[:-1]
+
+    return [round(float(x), 2) for x in annotation]
+
+def generate_annotations(n_pieces, n_annotators, n_measures, seed=0):
+    # One annotation round in the schema of vgmidi_raw_*.json
+    rng = np.random.RandomState(seed)
+
+    pieces, annotations = {}, {}
+    for i in range(n_pieces):
+        piece_id = "piece" + str(i)
+        pieces[piece_id] = {"audio": "audio/" + os.path.splitext(midi_name(i))[0] + ".mp3",
+                         "duration": n_measures * measure_length(),
+                         "measures": n_measures,
+                             "midi": "midi/" + midi_name(i),
+                             "name": "Piece " + str(i)}
+
+        valence = emotion_curve(rng, n_measures)
+        arousal = emotion_curve(rng, n_measures)
+
+        for j in range(n_annotators):
+            annotations[piece_id + "_" + str(j)] = {"age": AGES[rng.randint(len(AGES))],
+                                                "arousal": annotate(rng, arousal),
+                                                "valence": annotate(rng, valence),
+                                                "country": COUNTRIES[rng.randint(len(COUNTRIES))],
+                                            "ex1_arousal": round(float(rng.uniform(-1, 1)), 2),
+                                        "ex1_description": "",
+                                            "ex1_valence": round(float(rng.uniform(-1, 1)), 2),
+                                            "ex2_arousal": round(float(rng.uniform(-1, 1)), 2),
+                                            "ex2_valence": round(float(rng.uniform(-1, 1)), 2),
+                                                 "gender": GENDERS[rng.randint(len(GENDERS))],
+                                                "isKnown": bool(rng.rand() < 0.5),
+                                           "musicianship": int(rng.randint(1, 6))}
+
+    return {"annotations": annotations, "pieces": pieces}
+
+def generate_midi(n_measures, notes_per_measure, seed=0):
+    # Piano piece of evenly spaced notes, with random pitches and velocities
+    rng = np.random.RandomState(seed)
+
+    midi_data = pretty_midi.PrettyMIDI(initial_tempo=TEMPO)
+    piano = pretty_midi.Instrument(program=pretty_midi.instrument_name_to_program('Acoustic Grand Piano'))
+
+    n_notes = n_measures * notes_per_measure
+    step = measure_length()/notes_per_measure
+
+    starts = np.arange(n_notes) * step
+    pitches = rng.randint(MIN_PITCH, MAX_PITCH + 1, n_notes)
+    velocities = rng.randint(40, 110, n_notes)
+    durations = step * rng.uniform(0.5, 2, n_notes)
+
+    for start, pitch, velocity, duration in zip(starts, pitches, velocities, durations):
+        piano.notes.append(pretty_midi.Note(int(velocity), int(pitch), float(start), float(start + duration)))
+
+    midi_data.instruments.append(piano)
+    return midi_data
+
+def generate_corpus(output_path, n_pieces, n_annotators, n_measures, notes_per_measure, n_rounds=1, seed=0):
+    # Write annotation rounds and midi files laid out like labelled/annotations and labelled/midi.
+    # Returns the annotations dir and the midi dir.
+    annotations_path = os.path.join(output_path, "annotations")
+    midi_path = os.path.join(output_path, "midi")
+    os.makedirs(annotations_path, exist_ok=True)
+    os.makedirs(midi_path, exist_ok=True)
+
+    # Pieces are spread over the rounds, each round numbering its own pieces from 0
+    first_piece = 0
+    for r in range(n_rounds):
+        round_pieces = n_pieces//n_rounds + (r < n_pieces % n_rounds)
+        data = generate_annotations(round_pieces, n_annotators, n_measures, seed + r)
+
+        # Rename midis so pieces of different rounds don't share a file
+        for k, piece in enumerate(data["pieces"].values()):
+            piece["midi"] = "midi/" + midi_name(first_piece + k)
+
+        with open(os.path.join(annotations_path, "vgmidi_raw_" + str(r + 1) + ".json"), "w") as fp:
+            json.dump(data, fp)
+
+        first_piece += round_pieces
+
+    for i in range(n_pieces):
+        generate_midi(n_measures, notes_per_measure, seed + i).write(os.path.join(midi_path, midi_name(i)))
+
+    return annotations_path, midi_path
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='synthetic.py')
+    parser.add_argument('--out', type=str, required=True, help="Dir to write the annotations and midi dirs to.")
+    parser.add_argument('--pieces', type=int, default=100, help="Number of pieces.")
+    parser.add_argument('--annotators', type=int, default=30, help="Number of annotators per piece.")
+    parser.add_argument('--measures', type=int, default=32, help="Number of measures per piece.")
+    parser.add_argument('--notes', type=int, default=16, help="Number of notes per measure.")
+    parser.add_argument('--rounds', type=int, default=1, help="Number of annotation rounds (json files).")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+    opt = parser.parse_args()
+
+    generate_corpus(opt.out, opt.pieces, opt.annotators, opt.measures, opt.notes, opt.rounds, opt.seed)
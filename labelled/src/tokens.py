@@ -0,0 +1,146 @@
+import os
+import csv
+import argparse
+import numpy as np
+
+from store import write_store, read_store
+from rolls import MidiResolver
+
+# Event vocabulary: note-on and note-off of every pitch, time shifts of
+# 1..TIME_SHIFT_STEPS steps and VELOCITY_BINS velocity changes
+STEPS_PER_SECOND = 100
+TIME_SHIFT_STEPS = 100
+VELOCITY_BINS = 32
+
+NOTE_ON_OFFSET = 0
+NOTE_OFF_OFFSET = NOTE_ON_OFFSET + 128
+TIME_SHIFT_OFFSET = NOTE_OFF_OFFSET + 128
+VELOCITY_OFFSET = TIME_SHIFT_OFFSET + TIME_SHIFT_STEPS
+VOCABULARY_SIZE = VELOCITY_OFFSET + VELOCITY_BINS
+
+def encode_midi(midi_data):
+    events = []
+    for inst in midi_data.instruments:
+        if inst.is_drum:
+            continue
+
+        for note in inst.notes:
+            start = int(round(note.start * STEPS_PER_SECOND))
+            end = max(int(round(note.end * STEPS_PER_SECOND)), start + 1)
+
+            events.append((start, 1, note.pitch, note.velocity))
+            events.append((end, 0, note.pitch, 0))
+
+    # Note-offs go before note-ons of the same step, so repeated notes are not cut
+    events.sort(key=lambda e: (e[0], e[1], e[2]))
+
+    tokens = []
+    step, velocity_bin = 0, None
+    for time, is_note_on, pitch, velocity in events:
+        while step < time:
+            shift = min(time - step, TIME_SHIFT_STEPS)
+            tokens.append(TIME_SHIFT_OFFSET + shift - 1)
+            step += shift
+
+        if is_note_on:
+            # Velocity is only emitted when it changes
+            if velocity * VELOCITY_BINS // 128 != velocity_bin:
+                velocity_bin = velocity * VELOCITY_BINS // 128
+                tokens.append(VELOCITY_OFFSET + velocity_bin)
+            tokens.append(NOTE_ON_OFFSET + pitch)
+        else:
+            tokens.append(NOTE_OFF_OFFSET + pitch)
+
+    return np.array(tokens, dtype=np.uint16)
+
+def export_token_shard(csv_path, shard_path, read_midi):
+    ids, midis, sequences = [], [], []
+    valence, arousal = [], []
+
+    for row in csv.DictReader(open(csv_path, "r")):
+        # Labelled csv paths point into phrases.zip, so missing files are worth a warning
+        midi_location = read_midi.locate(row["midi"])
+        if midi_location != read_midi.zip_path and not os.path.isfile(midi_location):
+            print("----", "Midi file not found.", row["midi"])
+            continue
+
+        try:
+            midi_data = read_midi(row["midi"])
+        except Exception as e:
+            print("----", "Could not read midi file.", row["midi"], e)
+            continue
+
+        print("Encoding...", row["midi"])
+        sequences.append(encode_midi(midi_data))
+
+        ids.append(int(row["id"]))
+        midis.append(row["midi"])
+
+        # Unlabelled pieces get 0 for both dimensions
+        valence.append(int(row.get("valence", 0)))
+        arousal.append(int(row.get("arousal", 0)))
+
+    if len(sequences) == 0:
+        raise ValueError("No midi file of " + csv_path + " could be encoded.")
+
+    columns = {"tokens": np.concatenate(sequences + [np.zeros(0, dtype=np.uint16)]),
+              "offsets": np.cumsum([0] + [len(s) for s in sequences]).astype(np.int64),
+                  "ids": np.array(ids, dtype=np.int64),
+              "valence": np.array(valence, dtype=np.int8),
+              "arousal": np.array(arousal, dtype=np.int8)}
+
+    vocabulary = {"steps_per_second": STEPS_PER_SECOND,
+                  "time_shift_steps": TIME_SHIFT_STEPS,
+                     "velocity_bins": VELOCITY_BINS,
+                              "size": VOCABULARY_SIZE}
+
+    write_store(shard_path, columns, {"kind": "tokens", "vocabulary": vocabulary, "midi": midis})
+
+class TokenShard:
+    def __init__(self, shard_path):
+        self.buffer, self.header, self.columns = read_store(shard_path)
+
+        if self.header.get("kind") != "tokens":
+            raise ValueError(shard_path + " is not a token shard.")
+
+        self.tokens = self.columns["tokens"]
+        self.offsets = self.columns["offsets"]
+        self.ids = self.columns["ids"]
+        self.midi = self.header["midi"]
+        self.vocabulary = self.header["vocabulary"]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.sequence(i)
+
+    def sequence(self, i):
+        # Zero-copy view of the tokens of a piece
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def labels(self, i):
+        return int(self.columns["valence"][i]), int(self.columns["arousal"][i])
+
+    def window(self, i, start, length):
+        return self.sequence(i)[start:start + length]
+
+    def windows(self, i, length, stride=1):
+        # All fixed length windows of a piece as a strided view, without copying tokens
+        sequence = self.sequence(i)
+        if len(sequence) < length:
+            return np.zeros((0, length), dtype=self.tokens.dtype)
+
+        return np.lib.stride_tricks.sliding_window_view(sequence, length)[::stride]
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='tokens.py')
+    parser.add_argument('--csv', type=str, required=True, help="Dataset csv, like vgmidi_labelled.csv or vgmidi_unlabelled.csv.")
+    parser.add_argument('--out', type=str, required=True, help="Token shard output path.")
+    parser.add_argument('--root', type=str, default=".", help="Dir the csv midi paths are relative to.")
+    parser.add_argument('--midi', type=str, default=None, help="Dir to look midi files up by name.")
+    parser.add_argument('--zip', type=str, default=None, help="Phrases zip to look midi files up in.")
+    opt = parser.parse_args()
+
+    export_token_shard(opt.csv, opt.out, MidiResolver(opt.root, opt.midi, opt.zip))
@@ -0,0 +1,62 @@
+import os
+import sys
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from cache     import restore_cache_files
+from synthetic import generate_corpus
+
+BUILD_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "build_dataset.py")
+
+def build(corpus_path, at, phrases_path, cache_path=None):
+    os.makedirs(phrases_path, exist_ok=True)
+
+    args = [sys.executable, BUILD_DATASET, "--annotations", os.path.join(corpus_path, "annotations"),
+            "--midi", os.path.join(corpus_path, "midi"), "--phrases", phrases_path, "--plot_mode", "none",
+            "--at", str(at), "--out", phrases_path + ".csv"]
+    if cache_path is not None:
+        args += ["--cache", cache_path]
+
+    subprocess.run(args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    with open(phrases_path + ".csv", "r") as fp:
+        return fp.read().replace(phrases_path, "")
+
+def read_phrases(phrases_path):
+    phrases = {}
+    for filename in os.listdir(phrases_path):
+        with open(os.path.join(phrases_path, filename), "rb") as fp:
+            phrases[filename] = fp.read()
+    return phrases
+
+def test_restore_rewrites_changed_files(tmp_path):
+    missing, changed, same = str(tmp_path / "missing.mid"), str(tmp_path / "changed.mid"), str(tmp_path / "same.mid")
+    with open(changed, "wb") as fp:
+        fp.write(b"MThd other run")
+    with open(same, "wb") as fp:
+        fp.write(b"MThd this run")
+
+    restore_cache_files([(missing, b"MThd this run"), (changed, b"MThd this run"), (same, b"MThd this run")])
+
+    for path in [missing, changed, same]:
+        with open(path, "rb") as fp:
+            assert fp.read() == b"MThd this run"
+
+def test_cached_threshold_sweep_matches_fresh_build(tmp_path):
+    corpus_path = str(tmp_path / "corpus")
+    generate_corpus(corpus_path, n_pieces=6, n_annotators=10, n_measures=16, notes_per_measure=4)
+
+    # Phrases of both thresholds share names but not contents
+    phrases_path, cache_path = str(tmp_path / "phrases"), str(tmp_path / "cache")
+    build(corpus_path, 0.05, phrases_path, cache_path)
+    build(corpus_path, 0.2, phrases_path, cache_path)
+    cached_csv = build(corpus_path, 0.05, phrases_path, cache_path)
+
+    fresh_path = str(tmp_path / "fresh")
+    fresh_csv = build(corpus_path, 0.05, fresh_path)
+
+    assert cached_csv == fresh_csv
+
+    cached_phrases = read_phrases(phrases_path)
+    for filename, phrase_bytes in read_phrases(fresh_path).items():
+        assert cached_phrases[filename] == phrase_bytes, filename
@@ -0,0 +1,47 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from loader import PhraseDataset
+
+def write_csv(csv_path, n_rows):
+    with open(csv_path, "w") as fp:
+        fp.write("id,series,console,game,piece,midi,valence,arousal\n")
+        for i in range(n_rows):
+            fp.write("{},s,c,g,p,phrase_{}.mid,1,-1\n".format(i, i))
+
+def test_failed_prefetch_is_retried(tmp_path):
+    csv_path = str(tmp_path / "phrases.csv")
+    write_csv(csv_path, 2)
+
+    # The first read of every piece fails, later reads work
+    calls = []
+    release = threading.Event()
+    def read_midi(midi_path):
+        release.wait()
+        calls.append(midi_path)
+        if calls.count(midi_path) == 1:
+            raise OSError("Could not read " + midi_path)
+        return midi_path
+
+    dataset = PhraseDataset(csv_path, read_midi=read_midi)
+    dataset.prefetch([1])
+    release.set()
+
+    with pytest.raises(OSError):
+        dataset.load(1)
+
+    assert 1 not in dataset.pending
+    assert dataset.load(1) == "phrase_1.mid"
+    assert calls == ["phrase_1.mid", "phrase_1.mid"]
+
+    # The failed piece is prefetched again too
+    with pytest.raises(OSError):
+        dataset.load(0)
+    dataset.prefetch([0])
+    assert dataset.load(0) == "phrase_0.mid"
+
+    dataset.close()
@@ -1,15 +1,27 @@
 import os
+import sys
 import csv
+import json
 import shutil
 import argparse
 import unidecode
-import pretty_midi
 
-# Define min length in seconds for a midi file
-MIN_LENGTH=15
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+from midi_dedup import fingerprint_midi, fingerprint_sets, THRESHOLD
+
+# Modules shared with the labelled scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+from midi_scan import *
+from tracing   import *
+
+# Per file stages of the --profile summary
+PROFILE_STAGES = ["validate", "fingerprint", "copy"]
 
 # Games to remove from the unlabelled list. This is useful if you
-# want to fine-tune a classifier with some part of the games
+# want to fine-tune a classifier with some part of the games.
+# Not used when leaking pieces are found with --labelled instead.
 IGNORED_GAMES=["Banjo-Kazooie",
                "Banjo-Tooie",
                "Battle of Olympus",
@@ -41,79 +53,203 @@ IGNORED_GAMES=["Banjo-Kazooie",
                "The Legend of Zelda Ocarina of Time",
                "Xenogears"]
 
-# Parse arguments
-parser = argparse.ArgumentParser(description='midi_clean.py')
-parser.add_argument('--csv', type=str, required=True, help="Midi dataset.")
-parser.add_argument('--out', type=str, required=True, help="Output dir.")
-opt = parser.parse_args()
-
-# Define csv header
-cleaned_csv_columns = ['id','series','console', 'game', 'piece', 'midi', 'pdf']
-
-# Cleaned csv name
-cleaned_csv_filename = "vgmidi_metadata_cleaned.csv"
-cleaned_csv_filename = os.path.join(opt.out, cleaned_csv_filename)
-
-# Create set of ignored games
-ingnored_games = set(IGNORED_GAMES)
-
-# Create midi and pdf dirs
-os.mkdir(os.path.join(opt.out, "midi"))
-os.mkdir(os.path.join(opt.out, "pdf"))
-
-total_piece, total_time = 0, 0
-with open(cleaned_csv_filename, 'w') as csvfile:
-    writer = csv.DictWriter(csvfile, fieldnames=cleaned_csv_columns)
-    writer.writeheader()
-
+def clean_midi(midi_path, entry=None, fingerprint=False):
+    # One span per file, so workers flush their trace once per file
+    midi_name = os.path.basename(midi_path)
+    with span("file", midi_name):
+        with span("validate", midi_name):
+            entry = validate_midi(midi_path, entry)
+
+        # Only files that pass every other check need a fingerprint
+        if fingerprint and entry["verdict"] == "ok" and "signature" not in entry:
+            with span("fingerprint", midi_name):
+                signature = fingerprint_midi(midi_path)
+            entry = dict(entry, signature=None if signature is None else signature.tolist())
+
+    return entry
+
+def load_manifest(manifest_path):
+    manifest = {}
+    if not os.path.isfile(manifest_path):
+        return manifest
+
+    # Manifest is append only, so later lines override earlier ones
+    with open(manifest_path, "r") as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line of a crashed run might be incomplete
+                continue
+
+            manifest[entry.pop("path")] = entry
+
+    return manifest
+
+def save_manifest(manifest, manifest_path):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        for path, entry in manifest.items():
+            fp.write(json.dumps(dict(entry, path=path)) + "\n")
+
+    os.replace(tmp_path, manifest_path)
+
+def copy_file(src, dst):
+    # Files already copied by a previous run are left alone, unless the source was
+    # replaced or edited since. Copies get the mtime of their source to tell.
+    src_stat = os.stat(src)
+    if os.path.isfile(dst):
+        dst_stat = os.stat(dst)
+        if os.path.samefile(src, dst) or (dst_stat.st_size, dst_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns):
+            return
+        os.remove(dst)
+
+    # Hardlink when source and output are on the same filesystem
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    # Otherwise let the kernel copy the data without going through user space
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30) > 0:
+                    pass
+            os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            return
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
+    os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='midi_clean.py')
+    parser.add_argument('--csv', type=str, required=True, help="Midi dataset.")
+    parser.add_argument('--out', type=str, required=True, help="Output dir.")
+    parser.add_argument('--manifest', type=str, default=None, help="Manifest of cleaned files. Defaults to a file in the output dir.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes.")
+    parser.add_argument('--labelled', type=str, default=None, help="Dir or csv of labelled midi files. Unlabelled near-duplicates of them are removed instead of IGNORED_GAMES.")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help="Min estimated similarity of a near-duplicate.")
+    parser.add_argument('--profile', type=str, default=None, help="Time every stage of every file, save a chrome trace to this path and print the slowest files.")
+    opt = parser.parse_args()
+
+    # Workers append their spans to the trace dir as they finish files
+    trace_dir = None
+    if opt.profile is not None:
+        trace_dir = start_tracing()
+
+    # Define csv header
+    cleaned_csv_columns = ['id','series','console', 'game', 'piece', 'midi', 'pdf']
+
+    # Cleaned csv name
+    cleaned_csv_filename = "vgmidi_metadata_cleaned.csv"
+    cleaned_csv_filename = os.path.join(opt.out, cleaned_csv_filename)
+
+    # Create set of ignored games, or fingerprint the labelled pieces to find leaks by content
+    labelled_index = None
+    if opt.labelled is not None:
+        ingnored_games = set()
+        with span("fingerprint_labelled"):
+            labelled_index = fingerprint_sets([("labelled", opt.labelled)], workers=opt.workers)
+    else:
+        ingnored_games = set(IGNORED_GAMES)
+
+    # Create midi and pdf dirs, they already exist when resuming
+    os.makedirs(os.path.join(opt.out, "midi"), exist_ok=True)
+    os.makedirs(os.path.join(opt.out, "pdf"), exist_ok=True)
+
+    # Files cleaned by previous runs
+    manifest_path = opt.manifest
+    if manifest_path is None:
+        manifest_path = os.path.join(opt.out, "vgmidi_manifest.jsonl")
+    manifest = load_manifest(manifest_path)
+
+    # Rows to clean, in input order
+    rows = []
     for row in csv.DictReader(open(opt.csv, "r")):
         # Remove midi for two pianos and four hands
         if "Two Pianos" not in row['piece'] and "Four Hands" not in row['piece']:
             if row['game'] not in ingnored_games:
+                if os.path.isfile(row['pdf']) and os.path.isfile(row['midi']):
+                    rows.append(row)
+                else:
+                    print("----", "Either midi of pdf do not exist.", row['piece'])
+
+    # Validate midi files in parallel. Executor.map returns results in submission
+    # order, which keeps the csv identical to a serial run.
+    executor = None
+    midi_paths = [row['midi'] for row in rows]
+    if opt.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=opt.workers, initializer=enable_tracing, initargs=(trace_dir,))
+        entries = executor.map(clean_midi, midi_paths, [manifest.get(p) for p in midi_paths], repeat(labelled_index is not None), chunksize=16)
+    else:
+        entries = map(clean_midi, midi_paths, [manifest.get(p) for p in midi_paths], repeat(labelled_index is not None))
+
+    total_piece, total_time = 0, 0
+    with open(cleaned_csv_filename, 'w') as csvfile, open(manifest_path, 'a') as manifest_fp:
+        writer = csv.DictWriter(csvfile, fieldnames=cleaned_csv_columns)
+        writer.writeheader()
+
+        for row, entry in zip(rows, entries):
+            count(entry["verdict"])
+
+            # Record new verdicts right away, so a crash doesn't lose them
+            if manifest.get(row['midi']) == entry:
+                count("unchanged")
+            else:
+                manifest[row['midi']] = entry
+                manifest_fp.write(json.dumps(dict(entry, path=row['midi'])) + "\n")
+                manifest_fp.flush()
+
+            # Near-duplicates of labelled pieces would leak them into the unlabelled set
+            leaks = []
+            if labelled_index is not None and entry["verdict"] == "ok" and entry["signature"] is not None:
+                leaks = labelled_index.query(entry["signature"], opt.threshold)
+
+            if entry["verdict"] == "corrupt":
+                print("----", "Midi file seems corruct.", row['piece'])
+            elif entry["verdict"] == "non_piano":
+                print("----", "Midi file has non-piano instruments.", row['piece'])
+            elif entry["verdict"] == "too_short":
+                print("----", "Midi file is too short.", row['piece'])
+            elif len(leaks) > 0:
+                print("----", "Midi file is a near-duplicate of a labelled piece.", row['piece'], "~", os.path.basename(leaks[0][0][1]))
+                count("leaks")
+            else:
                 print("Copying piece...", row['piece'])
 
                 pdf_path = unidecode.unidecode(row['pdf'].split("/")[-1])
                 midi_path = unidecode.unidecode(row['midi'].split("/")[-1])
 
-                if os.path.isfile(row['pdf']) and os.path.isfile(row['midi']):
-                    try:
-                        # Get midi length in seconds
-                        midi_data = pretty_midi.PrettyMIDI(row['midi'])
-                    except:
-                        print("----", "Midi file seems corruct.")
-                        continue
-
-                    # Check midi file has only piano tracks
-                    non_piano_instruments = 0
-                    for inst in midi_data.instruments:
-                        # Only consider instruments from the piano family
-                        if pretty_midi.program_to_instrument_class(inst.program) != "Piano":
-                            non_piano_instruments += 1
-
-                    if non_piano_instruments == 0:
-                        # Check midi is not too short
-                        midi_length = midi_data.get_end_time()
-
-                        if midi_length > MIN_LENGTH:
-                            shutil.copyfile(row['pdf'], os.path.join(opt.out, "pdf", pdf_path))
-                            shutil.copyfile(row['midi'], os.path.join(opt.out, "midi", midi_path))
-
-                            row['series'] = unidecode.unidecode(row['series'])
-                            row['game'] = unidecode.unidecode(row['game'])
-                            row['pdf'] = os.path.join(opt.out, "pdf", pdf_path)
-                            row['midi'] = os.path.join(opt.out, "midi", midi_path)
-
-                            writer.writerow(row)
-
-                            # Compute stats
-                            total_piece += 1
-                            total_time  += midi_data.get_end_time()
-                        else:
-                            print("----", "Midi file is too short.")
-                    else:
-                        print("----", "Midi file has non-piano instruments.")
-                else:
-                    print("----", "Either midi of pdf do not exist.")
+                with span("copy", os.path.basename(row['midi'])):
+                    copy_file(row['pdf'], os.path.join(opt.out, "pdf", pdf_path))
+                    copy_file(row['midi'], os.path.join(opt.out, "midi", midi_path))
+
+                row['series'] = unidecode.unidecode(row['series'])
+                row['game'] = unidecode.unidecode(row['game'])
+                row['pdf'] = os.path.join(opt.out, "pdf", pdf_path)
+                row['midi'] = os.path.join(opt.out, "midi", midi_path)
+
+                writer.writerow(row)
+
+                # Compute stats
+                total_piece += 1
+                total_time  += entry["length"]
+
+    if executor is not None:
+        executor.shutdown()
+
+    # Compact the manifest down to the latest entry of each file
+    save_manifest(manifest, manifest_path)
+
+    print("Total pieces:", total_piece)
+    print("Total time (in seconds):", total_time)
 
-print("Total pieces:", total_piece)
-print("Total time (in seconds):", total_time)
+    if trace_dir is not None:
+        events, counters, rss = stop_tracing(trace_dir)
+        write_chrome_trace(events, rss, opt.profile)
+        print_trace_summary(events, counters, rss, PROFILE_STAGES, unit="file")
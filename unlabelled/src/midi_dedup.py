@@ -0,0 +1,200 @@
+import os
+import csv
+import argparse
+import pretty_midi
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+# Notes per shingle, counted in melody steps
+NGRAM = 4
+
+# MinHash signature length, split in LSH bands of NUM_PERM/BANDS rows
+NUM_PERM = 128
+BANDS = 32
+
+# Min estimated jaccard similarity of near-duplicates
+THRESHOLD = 0.5
+
+# Onset quantization in steps per second, and clipping of intervals and rhythm ratios
+ONSET_STEPS = 100
+MAX_INTERVAL = 24
+MAX_RATIO = 3
+
+# Hashes are computed modulo a mersenne prime small enough for a*x+b to fit in 64 bits
+MERSENNE_PRIME = (1 << 31) - 1
+
+# Fixed permutations, so signatures of different runs can be compared
+PERM_A = np.random.RandomState(1).randint(1, MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+PERM_B = np.random.RandomState(2).randint(0, MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+
+def melody_notes(midi_data):
+    # Skyline melody: the highest pitch starting at each onset
+    notes = [(n.start, n.pitch) for inst in midi_data.instruments if not inst.is_drum for n in inst.notes]
+    if len(notes) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    notes = np.array(notes)
+    onsets = np.round(notes[:, 0] * ONSET_STEPS).astype(np.int64)
+    pitches = notes[:, 1].astype(np.int64)
+
+    order = np.lexsort((-pitches, onsets))
+    onsets, pitches = onsets[order], pitches[order]
+
+    first = np.concatenate([[True], onsets[1:] != onsets[:-1]])
+    return onsets[first], pitches[first]
+
+def shingles(midi_data, n=NGRAM):
+    onsets, pitches = melody_notes(midi_data)
+    if len(onsets) < n + 2:
+        return np.zeros(0, dtype=np.uint64)
+
+    # Pitch intervals are invariant to transposition, ratios of inter-onset intervals to tempo
+    intervals = np.clip(np.diff(pitches), -MAX_INTERVAL, MAX_INTERVAL)
+    iois = np.diff(onsets)
+    ratios = np.clip(np.round(np.log2(iois[1:]/iois[:-1])), -MAX_RATIO, MAX_RATIO).astype(np.int64)
+
+    n_symbols = (2*MAX_INTERVAL + 1) * (2*MAX_RATIO + 1)
+    symbols = (intervals[1:] + MAX_INTERVAL) * (2*MAX_RATIO + 1) + (ratios + MAX_RATIO)
+
+    # Each n-gram of symbols as one integer in base n_symbols
+    grams = np.zeros(len(symbols) - n + 1, dtype=np.int64)
+    for k in range(n):
+        grams = grams * n_symbols + symbols[k:len(symbols) - n + 1 + k]
+
+    return np.unique(grams % MERSENNE_PRIME).astype(np.uint64)
+
+def minhash(shingle_set):
+    hashes = (PERM_A[:, None] * shingle_set[None, :] + PERM_B[:, None]) % MERSENNE_PRIME
+    return hashes.min(axis=1).astype(np.uint32)
+
+def fingerprint_midi(midi_path):
+    try:
+        midi_data = pretty_midi.PrettyMIDI(midi_path)
+    except:
+        print("----", "Midi file seems corruct.", midi_path)
+        return None
+
+    shingle_set = shingles(midi_data)
+    if len(shingle_set) == 0:
+        return None
+
+    return minhash(shingle_set)
+
+class LSHIndex:
+    def __init__(self, bands=BANDS):
+        self.bands = bands
+        self.buckets = {}
+        self.signatures = {}
+
+    def band_keys(self, signature):
+        for band, rows in enumerate(np.split(np.asarray(signature, dtype=np.uint32), self.bands)):
+            yield band, rows.tobytes()
+
+    def add(self, key, signature):
+        self.signatures[key] = np.asarray(signature, dtype=np.uint32)
+        for band_key in self.band_keys(signature):
+            if band_key not in self.buckets:
+                self.buckets[band_key] = []
+            self.buckets[band_key].append(key)
+
+    def similarity(self, signature, key):
+        return float(np.mean(self.signatures[key] == signature))
+
+    def query(self, signature, threshold=THRESHOLD):
+        # Only pieces sharing a whole band with the signature are compared
+        signature = np.asarray(signature, dtype=np.uint32)
+
+        candidates = set()
+        for band_key in self.band_keys(signature):
+            candidates.update(self.buckets.get(band_key, []))
+
+        matches = [(key, self.similarity(signature, key)) for key in candidates]
+        return sorted([m for m in matches if m[1] >= threshold], key=lambda m: -m[1])
+
+    def pairs(self, threshold=THRESHOLD):
+        # Near-duplicate pairs inside the index, from the candidates of every bucket
+        candidates = set()
+        for keys in self.buckets.values():
+            for i in range(len(keys)):
+                for j in range(i + 1, len(keys)):
+                    candidates.add((keys[i], keys[j]))
+
+        pairs = []
+        for a, b in candidates:
+            similarity = self.similarity(self.signatures[a], b)
+            if similarity >= threshold:
+                pairs.append((a, b, similarity))
+
+        return sorted(pairs, key=lambda p: -p[2])
+
+def list_midi_files(path, midi_dir=None):
+    # Midi files of a dir, or of the midi column of a csv, looked up by name in midi_dir if given
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if os.path.splitext(f)[1].lower() in [".mid", ".midi"])
+
+    midi_paths = []
+    for row in csv.DictReader(open(path, "r")):
+        midi_path = row["midi"]
+        if midi_dir is not None:
+            midi_path = os.path.join(midi_dir, os.path.basename(midi_path))
+
+        if os.path.isfile(midi_path):
+            midi_paths.append(midi_path)
+
+    return midi_paths
+
+def fingerprint_sets(sets, midi_dir=None, workers=1):
+    # Fingerprint the midi files of every (name, path) set into one index keyed by (name, midi path)
+    keys = [(name, midi_path) for name, path in sets for midi_path in list_midi_files(path, midi_dir)]
+
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        signatures = executor.map(fingerprint_midi, [k[1] for k in keys], chunksize=16)
+    else:
+        signatures = map(fingerprint_midi, [k[1] for k in keys])
+
+    index = LSHIndex()
+    for key, signature in zip(keys, signatures):
+        if signature is not None:
+            index.add(key, signature)
+
+    if executor is not None:
+        executor.shutdown()
+
+    return index
+
+def persist_duplicates(pairs, output_path):
+    with open(output_path, mode='w') as fp:
+        fp_writer = csv.writer(fp)
+        fp_writer.writerow(["set_a", "midi_a", "set_b", "midi_b", "similarity", "leakage"])
+
+        for (set_a, midi_a), (set_b, midi_b), similarity in pairs:
+            fp_writer.writerow([set_a, midi_a, set_b, midi_b, similarity, set_a != set_b])
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='midi_dedup.py')
+    parser.add_argument('--set', type=str, nargs=2, action='append', required=True, metavar=('NAME', 'PATH'), help="Named set of midi files, from a dir or a csv. Repeat for each set.")
+    parser.add_argument('--midi', type=str, default=None, help="Dir to look csv midi files up by name.")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help="Min estimated similarity of near-duplicates.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes.")
+    parser.add_argument('--out', type=str, default=None, help="Path to save the near-duplicate pairs as csv.")
+    opt = parser.parse_args()
+
+    index = fingerprint_sets(opt.set, opt.midi, opt.workers)
+    pairs = index.pairs(opt.threshold)
+
+    # Near-duplicates across sets leak one set into the other
+    leaks = [p for p in pairs if p[0][0] != p[1][0]]
+
+    for (set_a, midi_a), (set_b, midi_b), similarity in pairs:
+        print("{:.3f}".format(similarity), set_a, os.path.basename(midi_a), "<->", set_b, os.path.basename(midi_b))
+
+    print("Fingerprinted pieces:", len(index.signatures))
+    print("Near-duplicate pairs:", len(pairs))
+    print("Pairs leaking across sets:", len(leaks))
+
+    if opt.out is not None:
+        persist_duplicates(pairs, opt.out)
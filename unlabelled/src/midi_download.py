@@ -1,15 +1,224 @@
 import os
 import re
-import ssl
 import csv
+import json
+import random
+import asyncio
+import aiohttp
+import hashlib
 import unidecode
-import urllib.request
 import argparse
+import importlib.util
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 MIDI_EXTENSIONS = [".mid", ".midi", ".MID", ".MIDI"]
 
+# Max number of open connections to the same host
+CONNECTIONS_PER_HOST = 8
+
+# Retries of a failed request, waiting BACKOFF * 2^attempt seconds in between
+RETRIES = 4
+BACKOFF = 1.0
+
+# Responses worth retrying, anything else is a permanent failure
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Size of the chunks streamed to disk
+CHUNK_SIZE = 1 << 16
+
+# Use the faster lxml parser backend when it's installed
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
+
+class DownloadError(Exception):
+    pass
+
+class Fetcher:
+    # Shares one pool of keep-alive connections between all requests
+    def __init__(self, connections_per_host=CONNECTIONS_PER_HOST, retries=RETRIES, backoff=BACKOFF, timeout=60):
+        self.connections_per_host = connections_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = None
+
+    async def __aenter__(self):
+        # Certificates are not verified, like the urllib version of this script did
+        connector = aiohttp.TCPConnector(limit_per_host=self.connections_per_host, ssl=False)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    async def request(self, method, url, handle_response, headers=None):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.request(method, url, headers=headers) as response:
+                    if response.status < 400:
+                        return await handle_response(response)
+
+                    error = DownloadError(url + " returned status " + str(response.status))
+                    if response.status not in RETRY_STATUS:
+                        raise error
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = DownloadError(url + " failed: " + repr(e))
+
+            if attempt < self.retries:
+                # Exponential backoff with jitter, so retries don't hit the host all at once
+                await asyncio.sleep(self.backoff * 2**attempt * (0.5 + random.random()))
+
+        raise error
+
+    async def fetch(self, url):
+        async def read(response):
+            return await response.read()
+
+        return await self.request("GET", url, read)
+
+    async def fetch_conditional(self, url, etag=None, last_modified=None):
+        # Ask the server to reply 304 with no body if the page didn't change
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+
+        async def read(response):
+            validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+            if response.status == 304:
+                return None, validators
+            return await response.read(), validators
+
+        return await self.request("GET", url, read, headers)
+
+    async def content_length(self, url):
+        async def length(response):
+            return response.content_length
+
+        return await self.request("HEAD", url, length)
+
+    async def download(self, url, path):
+        async def stream(response):
+            md5 = hashlib.md5()
+
+            # Stream into a temp file, so an interrupted download never looks complete
+            tmp_path = path + ".part"
+            try:
+                with open(tmp_path, "wb") as fp:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        fp.write(chunk)
+                        md5.update(chunk)
+            except BaseException:
+                # Failed or cancelled downloads leave nothing behind
+                if os.path.isfile(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+            os.replace(tmp_path, path)
+            return {"url": url, "size": os.path.getsize(path), "md5": md5.hexdigest()}
+
+        return await self.request("GET", url, stream)
+
+class PageCache:
+    # Keeps the parsed contents of html pages with the validators of the response
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        os.makedirs(cache_path, exist_ok=True)
+
+    def entry_path(self, url):
+        return os.path.join(self.cache_path, hashlib.md5(url.encode("utf-8")).hexdigest() + ".json")
+
+    def load(self, url):
+        entry_path = self.entry_path(url)
+        if not os.path.isfile(entry_path):
+            return None
+
+        try:
+            with open(entry_path, "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            print("----", "Page cache entry seems corrupt.")
+            return None
+
+    def save(self, url, validators, data):
+        # Pages without validators can't be revalidated, so there is no point keeping them
+        if validators["etag"] is None and validators["last_modified"] is None:
+            return
+
+        entry_path = self.entry_path(url)
+        tmp_path = entry_path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(dict(validators, url=url, data=data), fp)
+
+        os.replace(tmp_path, entry_path)
+
+async def fetch_page(fetcher, url, parse_page, page_cache=None):
+    entry = None
+    if page_cache is not None:
+        entry = page_cache.load(url)
+
+    if entry is None:
+        html, validators = await fetcher.fetch_conditional(url)
+    else:
+        html, validators = await fetcher.fetch_conditional(url, entry["etag"], entry["last_modified"])
+
+    # Unchanged pages are neither downloaded nor parsed again
+    if html is None:
+        print("Cached...", url)
+        return entry["data"]
+
+    print("Parsing...", url)
+    data = parse_page(html)
+
+    if page_cache is not None:
+        page_cache.save(url, validators, data)
+
+    return data
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+def load_manifest(manifest_path):
+    manifest = {}
+    if not os.path.isfile(manifest_path):
+        return manifest
+
+    # Manifest is append only, so later lines override earlier ones
+    with open(manifest_path, "r") as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line of an interrupted run might be incomplete
+                continue
+
+            manifest[entry.pop("path")] = entry
+
+    return manifest
+
+async def download_file(fetcher, url, path, manifest, manifest_fp):
+    # Skip files a previous run already downloaded completely
+    if os.path.isfile(path):
+        entry = manifest.get(path)
+        if entry is not None and entry["url"] == url:
+            if entry["size"] == os.path.getsize(path) and entry["md5"] == file_md5(path):
+                return
+
+        elif os.path.getsize(path) == await fetcher.content_length(url):
+            return
+
+    entry = await fetcher.download(url, path)
+
+    manifest[path] = entry
+    manifest_fp.write(json.dumps(dict(entry, path=path)) + "\n")
+    manifest_fp.flush()
+
 def clean_name(name, invalid_chars=[":", "_", ".", "~", "'", '"', "/"]):
     # Remove invalid chars
     valid_name = ''.join(c for c in name if c not in invalid_chars)
@@ -20,17 +229,20 @@ def clean_name(name, invalid_chars=[":", "_", ".", "~", "'", '"', "/"]):
 
     return ascii_encoding
 
-def get_series_metadata(series_url):
-    print("Parsing...", series_url)
-    games = {}
+def parse_series_list(html, parser=HTML_PARSER):
+    # Only build the tree of the series list
+    soup = BeautifulSoup(html, features=parser, parse_only=SoupStrainer("ul", {"class": "browseCategoryList"}))
 
-    # Download html from game url
-    context = ssl._create_unverified_context()
-    with urllib.request.urlopen(series_url, context=context) as response:
-        game_html = response.read()
+    # Get list of all game series
+    series_list = soup.find("ul", {"class": "browseCategoryList"})
 
-    # Parse game html
-    game_soup = BeautifulSoup(game_html, features="html.parser")
+    return [(litag.string, litag.get('href')) for litag in series_list.find_all('a')]
+
+def parse_series_page(html, parser=HTML_PARSER):
+    games = {}
+
+    # Only build the trees of the game sections, the rest of the page is never used
+    game_soup = BeautifulSoup(html, features=parser, parse_only=SoupStrainer("section", {"class": "game"}))
 
     # Get list of all games
     games_list = game_soup.find_all("section", {"class": "game"})
@@ -56,79 +268,124 @@ def get_series_metadata(series_url):
             games[midi_id] = {"console": clean_name(console_name),
                                  "game": clean_name(game_name),
                                 "piece": clean_name(midi_name),
-                              "pdf_url": opt.url + pdf_url,
-                             "midi_url": opt.url + midi_url }
+                              "pdf_url": pdf_url,
+                             "midi_url": midi_url }
 
     return games
 
-# Parse arguments
-parser = argparse.ArgumentParser(description='midi_download.py')
-parser.add_argument('--url', type=str, required=True, help="URL to download files from.")
-parser.add_argument('--out', type=str, default=".", help="Output dir.")
-parser.set_defaults(local=False)
-opt = parser.parse_args()
-
-# Download html from url
-context = ssl._create_unverified_context()
-with urllib.request.urlopen(opt.url + "/browse/series", context=context) as response:
-    html = response.read()
+async def get_series_metadata(fetcher, base_url, series_url, page_cache=None, parser=HTML_PARSER):
+    games = await fetch_page(fetcher, series_url, lambda html: parse_series_page(html, parser), page_cache)
 
-# Create parser from html
-soup = BeautifulSoup(html, features="html.parser")
+    # Urls are cached relative, so the same cache works for any mirror
+    for metadata in games.values():
+        metadata["pdf_url"] = base_url + metadata["pdf_url"]
+        metadata["midi_url"] = base_url + metadata["midi_url"]
 
-# Create csv file
-csv_columns = ['id','series','console', 'game', 'piece', 'midi', 'pdf']
-
-# Get list of all game series
-series_list = soup.find("ul", {"class": "browseCategoryList"})
-
-# Parse each game series
-all_games = []
-for litag in series_list.find_all('a'):
-    series_url = opt.url + litag.get('href')
-    series_name = clean_name(litag.string)
-    series_games = get_series_metadata(series_url)
-
-    for id, metadata in series_games.items():
-        print(id)
-        print(metadata)
-
-        # Define local filename
-        local_filename = series_name + "_" + metadata["console"] + "_" + metadata["game"] + "_" + metadata["piece"]
-
-        pdf_filename = os.path.join(opt.out, "pdf", local_filename + ".pdf")
-        midi_filename = os.path.join(opt.out, "midi", local_filename + ".mid")
+    return games
 
-        try:
-            # Download pdf file
-            with urllib.request.urlopen(metadata["pdf_url"], context=context) as response:
-                with open(pdf_filename, "wb") as fp:
-                    fp.write(response.read())
-
-            # Download midi file
-            with urllib.request.urlopen(metadata["midi_url"], context=context) as response:
-                with open(midi_filename, "wb") as fp:
-                    fp.write(response.read())
-
-            # Include in the final dict
-            all_games.append({'id': id,
-                          'series': series_name,
-                         'console': metadata["console"],
-                            'game': metadata["game"],
-                           'piece': metadata["piece"],
-                            'midi': midi_filename,
-                             'pdf': pdf_filename})
-        except:
-            print("Could not download file.")
-
-        print("==========")
-
-csv_filename = "vgmidi_metadata.csv"
-csv_filename = os.path.join(opt.out, csv_filename)
-
-with open(csv_filename, 'w') as csvfile:
-    writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
-    writer.writeheader()
-
-    for data in all_games:
-        writer.writerow(data)
+async def gather_all(*coroutines):
+    # Like asyncio.gather, but if one fails the others are cancelled and awaited before
+    # the error is raised, so none outlives the fetcher or the manifest it writes to
+    tasks = [asyncio.ensure_future(c) for c in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def piece_filename(series_name, metadata):
+    return series_name + "_" + metadata["console"] + "_" + metadata["game"] + "_" + metadata["piece"]
+
+async def download_piece(fetcher, id, series_name, metadata, out_path, manifest, manifest_fp):
+    # Define local filename
+    local_filename = piece_filename(series_name, metadata)
+
+    pdf_filename = os.path.join(out_path, "pdf", local_filename + ".pdf")
+    midi_filename = os.path.join(out_path, "midi", local_filename + ".mid")
+
+    try:
+        # Download pdf and midi files
+        await gather_all(download_file(fetcher, metadata["pdf_url"], pdf_filename, manifest, manifest_fp),
+                         download_file(fetcher, metadata["midi_url"], midi_filename, manifest, manifest_fp))
+    except (DownloadError, OSError) as e:
+        print("Could not download file.", e)
+        return None
+
+    print("Downloaded...", local_filename)
+
+    return {'id': id,
+        'series': series_name,
+       'console': metadata["console"],
+          'game': metadata["game"],
+         'piece': metadata["piece"],
+          'midi': midi_filename,
+           'pdf': pdf_filename}
+
+async def download_corpus(base_url, out_path, manifest_path, connections_per_host=CONNECTIONS_PER_HOST, page_cache=None, parser=HTML_PARSER):
+    # Create midi and pdf dirs, they already exist when resuming
+    os.makedirs(os.path.join(out_path, "midi"), exist_ok=True)
+    os.makedirs(os.path.join(out_path, "pdf"), exist_ok=True)
+
+    manifest = load_manifest(manifest_path)
+
+    async with Fetcher(connections_per_host) as fetcher:
+        # Get list of all game series
+        series_list = await fetch_page(fetcher, base_url + "/browse/series", lambda html: parse_series_list(html, parser), page_cache)
+
+        # Parse all game series concurrently
+        series_names = [clean_name(name) for name, href in series_list]
+        series_games = await gather_all(*[get_series_metadata(fetcher, base_url, base_url + href, page_cache, parser) for name, href in series_list])
+
+        # Download every piece concurrently, the connector bounds requests per host
+        with open(manifest_path, "a") as manifest_fp:
+            # Sheets whose names clean to the same file share one download, so no two
+            # tasks ever write the same path. Their csv rows share the file.
+            downloads, pieces = {}, []
+            for series_name, games in zip(series_names, series_games):
+                for id, metadata in games.items():
+                    local_filename = piece_filename(series_name, metadata)
+                    if local_filename not in downloads:
+                        downloads[local_filename] = download_piece(fetcher, id, series_name, metadata, out_path, manifest, manifest_fp)
+                    pieces.append((id, local_filename))
+
+            downloaded = dict(zip(downloads.keys(), await gather_all(*downloads.values())))
+
+    # Rows keep the order of the series pages
+    return [dict(downloaded[local_filename], id=id) for id, local_filename in pieces if downloaded[local_filename] is not None]
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='midi_download.py')
+    parser.add_argument('--url', type=str, required=True, help="URL to download files from.")
+    parser.add_argument('--out', type=str, default=".", help="Output dir.")
+    parser.add_argument('--connections', type=int, default=CONNECTIONS_PER_HOST, help="Max concurrent connections per host.")
+    parser.add_argument('--manifest', type=str, default=None, help="Manifest of downloaded files. Defaults to a file in the output dir.")
+    parser.add_argument('--page_cache', type=str, default=None, help="Dir to cache parsed html pages in.")
+    parser.add_argument('--parser', type=str, default=HTML_PARSER, choices=["lxml", "html.parser", "html5lib"], help="BeautifulSoup parser backend.")
+    parser.set_defaults(local=False)
+    opt = parser.parse_args()
+
+    manifest_path = opt.manifest
+    if manifest_path is None:
+        manifest_path = os.path.join(opt.out, "vgmidi_downloads.jsonl")
+
+    page_cache = None
+    if opt.page_cache is not None:
+        page_cache = PageCache(opt.page_cache)
+
+    all_games = asyncio.run(download_corpus(opt.url, opt.out, manifest_path, opt.connections, page_cache, opt.parser))
+
+    # Create csv file
+    csv_columns = ['id','series','console', 'game', 'piece', 'midi', 'pdf']
+
+    csv_filename = "vgmidi_metadata.csv"
+    csv_filename = os.path.join(opt.out, csv_filename)
+
+    with open(csv_filename, 'w') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
+        writer.writeheader()
+
+        for data in all_games:
+            writer.writerow(data)
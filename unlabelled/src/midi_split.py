@@ -1,11 +1,15 @@
 import os
 import csv
+import json
 import shutil
 import argparse
 import numpy as np
 
 from sklearn.model_selection import GroupShuffleSplit
 
+# Name of the split manifest in the output dir
+SPLIT_MANIFEST = "vgmidi_splits.json"
+
 def get_data_for_training(midi_csv, midi_dir):
     x, y, groups = [], [], []
 
@@ -20,29 +24,112 @@ def get_data_for_training(midi_csv, midi_dir):
 
     return np.array(x), np.array(y), np.array(groups)
 
-# Parse arguments
-parser = argparse.ArgumentParser(description='midi_split.py')
-parser.add_argument('--csv', type=str, required=True, help="Midi dataset.")
-parser.add_argument('--midi', type=str, required=True, help="Path to midi files.")
-parser.add_argument('--out', type=str, default=".", help="Output dir.")
-opt = parser.parse_args()
+def group_shuffle_split(xs, ys, groups, train_size=.85, seed=42):
+    # Same single split as always, -1 marks train files and 0 test files
+    folds = np.full(len(ys), -1)
+
+    kfold = GroupShuffleSplit(n_splits=1, train_size=train_size, test_size=round(1 - train_size, 10), random_state=seed)
+    for train_index, test_index in kfold.split(xs, ys, groups):
+        folds[test_index] = 0
+
+    return folds
+
+def group_kfold(groups, n_folds, seed=42):
+    # Assign whole games to folds, so a game is never in train and test at the same time.
+    # Games are shuffled, then the largest ones go first to the smallest fold, like GroupKFold.
+    unique_groups, group_index, group_sizes = np.unique(groups, return_inverse=True, return_counts=True)
+
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(len(unique_groups))
+    order = order[np.argsort(-group_sizes[order], kind="stable")]
+
+    fold_sizes = np.zeros(n_folds, dtype=int)
+    group_folds = np.zeros(len(unique_groups), dtype=int)
+    for g in order:
+        fold = np.argmin(fold_sizes)
+        group_folds[g] = fold
+        fold_sizes[fold] += group_sizes[g]
+
+    return group_folds[group_index]
+
+def save_split_manifest(manifest_path, ys, groups, folds, midi_dir, seed, n_folds, train_size):
+    manifest = {"midi": os.path.abspath(midi_dir),
+                "seed": seed,
+               "folds": n_folds,
+          "train_size": train_size,
+               "files": ys.tolist(),
+              "groups": groups.tolist(),
+          "assignment": folds.tolist()}
+
+    with open(manifest_path, "w") as fp:
+        json.dump(manifest, fp)
+
+def load_split(manifest_path, fold=0):
+    # Returns the train and test midi paths of a fold straight from the manifest
+    with open(manifest_path, "r") as fp:
+        manifest = json.load(fp)
+
+    if fold >= manifest["folds"]:
+        raise ValueError("Manifest has " + str(manifest["folds"]) + " folds, can't load fold " + str(fold))
+
+    train, test = [], []
+    for filename, assignment in zip(manifest["files"], manifest["assignment"]):
+        midi_path = os.path.join(manifest["midi"], filename)
+        if assignment == fold:
+            test.append(midi_path)
+        else:
+            train.append(midi_path)
+
+    return train, test
+
+def materialize_file(src, dst, mode):
+    if mode == "symlink":
+        os.symlink(os.path.abspath(src), dst)
+    elif mode == "hardlink":
+        os.link(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+def materialize_split(manifest_path, fold, out_path, mode):
+    train, test = load_split(manifest_path, fold)
+
+    # Create train and test directories
+    for split_name, midi_paths in [("train", train), ("test", test)]:
+        split_path = os.path.join(out_path, split_name)
+        os.mkdir(split_path)
+
+        for midi_path in midi_paths:
+            materialize_file(midi_path, os.path.join(split_path, os.path.basename(midi_path)), mode)
 
-# Load midi data
-xs, ys, groups = get_data_for_training(opt.csv, opt.midi)
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='midi_split.py')
+    parser.add_argument('--csv', type=str, required=True, help="Midi dataset.")
+    parser.add_argument('--midi', type=str, required=True, help="Path to midi files.")
+    parser.add_argument('--out', type=str, default=".", help="Output dir.")
+    parser.add_argument('--folds', type=int, default=1, help="Number of group k-folds. 1 makes a single train/test split.")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed of the split.")
+    parser.add_argument('--train_size', type=float, default=.85, help="Fraction of files in train, when making a single split.")
+    parser.add_argument('--mode', type=str, default="copy", choices=["copy", "hardlink", "symlink", "manifest"], help="Copy or link files into split dirs, or only write the split manifest.")
+    opt = parser.parse_args()
 
-# Create train and test directories
-os.mkdir(os.path.join(opt.out, "train"))
-os.mkdir(os.path.join(opt.out, "test"))
+    # Load midi data
+    xs, ys, groups = get_data_for_training(opt.csv, opt.midi)
 
-# Split dataset
-kfold = GroupShuffleSplit(n_splits=1, train_size=.85, test_size=.15, random_state=42)
-for train_index, test_index in kfold.split(xs, ys, groups):
-    y_train, y_test = ys[train_index], ys[test_index]
+    # Split dataset
+    if opt.folds > 1:
+        folds = group_kfold(groups, opt.folds, opt.seed)
+    else:
+        folds = group_shuffle_split(xs, ys, groups, opt.train_size, opt.seed)
 
-    for y in y_train:
-        midi_path = os.path.join(opt.midi, y)
-        shutil.copyfile(midi_path, os.path.join(opt.out, "train", y))
+    manifest_path = os.path.join(opt.out, SPLIT_MANIFEST)
+    save_split_manifest(manifest_path, ys, groups, folds, opt.midi, opt.seed, opt.folds, opt.train_size)
 
-    for y in y_test:
-        midi_path = os.path.join(opt.midi, y)
-        shutil.copyfile(midi_path, os.path.join(opt.out, "test", y))
+    if opt.mode != "manifest":
+        if opt.folds > 1:
+            for fold in range(opt.folds):
+                fold_path = os.path.join(opt.out, "fold_" + str(fold))
+                os.mkdir(fold_path)
+                materialize_split(manifest_path, fold, fold_path, opt.mode)
+        else:
+            materialize_split(manifest_path, 0, opt.out, opt.mode)
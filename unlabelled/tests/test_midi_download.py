@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import asyncio
+import hashlib
+
+import pytest
+from aiohttp import web
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from midi_download import Fetcher, PageCache, DownloadError, fetch_page, download_piece, download_corpus
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+MIDI_BYTES = b"MThd" + bytes(range(256)) * 64
+PDF_BYTES = b"%PDF-1.4" + bytes(range(256)) * 16
+
+# Html pages of the stand-in, by path
+PAGES = {"/browse/series": "series_list.html",
+          "/series/mario": "series_mario.html"}
+
+class StandIn:
+    # Local http server standing in for the midi site, counting the requests of every path
+    def __init__(self):
+        self.requests = {}
+        self.methods = []
+        self.failures = {}
+        self.app = web.Application()
+        self.app.router.add_route("*", "/{path:.*}", self.handle)
+
+    async def handle(self, request):
+        path = "/" + request.match_info["path"]
+        self.requests[path] = self.requests.get(path, 0) + 1
+        self.methods.append((request.method, path))
+
+        # Fail the first requests of a path with a retryable status
+        if self.failures.get(path, 0) > 0:
+            self.failures[path] -= 1
+            return web.Response(status=503)
+
+        if path == "/page":
+            if request.headers.get("If-None-Match") == '"v1"':
+                return web.Response(status=304, headers={"ETag": '"v1"'})
+            return web.Response(text="<html>page</html>", headers={"ETag": '"v1"'})
+
+        if path in PAGES:
+            with open(os.path.join(FIXTURES, PAGES[path]), "r") as fp:
+                return web.Response(text=fp.read(), content_type="text/html")
+
+        if path == "/piece.mid" or (path.startswith("/sheets/") and path.endswith(".mid")):
+            return web.Response(body=MIDI_BYTES)
+
+        if path.startswith("/sheets/") and path.endswith(".pdf"):
+            return web.Response(body=PDF_BYTES)
+
+        if path == "/slow.mid":
+            # Streams forever, so it is still running when its sibling fails
+            response = web.StreamResponse()
+            await response.prepare(request)
+            while True:
+                await response.write(MIDI_BYTES)
+                await asyncio.sleep(0.01)
+
+        return web.Response(status=404)
+
+async def serve(stand_in):
+    runner = web.AppRunner(stand_in.app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, "http://127.0.0.1:" + str(port)
+
+def run_with_server(test):
+    stand_in = StandIn()
+
+    async def main():
+        runner, base_url = await serve(stand_in)
+        try:
+            async with Fetcher(retries=2, backoff=0) as fetcher:
+                return await test(fetcher, base_url, stand_in)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(main())
+
+def test_download_retries_retryable_status(tmp_path):
+    path = str(tmp_path / "piece.mid")
+
+    async def test(fetcher, base_url, stand_in):
+        stand_in.failures["/piece.mid"] = 2
+        entry = await fetcher.download(base_url + "/piece.mid", path)
+        return entry, stand_in.requests["/piece.mid"]
+
+    entry, n_requests = run_with_server(test)
+
+    assert n_requests == 3
+    assert entry["md5"] == hashlib.md5(MIDI_BYTES).hexdigest()
+    with open(path, "rb") as fp:
+        assert fp.read() == MIDI_BYTES
+
+def test_download_gives_up_after_retries(tmp_path):
+    async def test(fetcher, base_url, stand_in):
+        stand_in.failures["/piece.mid"] = 10
+        with pytest.raises(DownloadError):
+            await fetcher.download(base_url + "/piece.mid", str(tmp_path / "piece.mid"))
+        return stand_in.requests["/piece.mid"]
+
+    assert run_with_server(test) == 3
+    assert os.listdir(tmp_path) == []
+
+def test_not_found_is_not_retried(tmp_path):
+    async def test(fetcher, base_url, stand_in):
+        with pytest.raises(DownloadError):
+            await fetcher.download(base_url + "/missing.mid", str(tmp_path / "missing.mid"))
+        return stand_in.requests["/missing.mid"]
+
+    assert run_with_server(test) == 1
+    assert os.listdir(tmp_path) == []
+
+def test_not_modified_page_comes_from_cache(tmp_path):
+    page_cache = PageCache(str(tmp_path))
+    parsed = []
+
+    def parse_page(html):
+        parsed.append(html)
+        return {"length": len(html)}
+
+    async def test(fetcher, base_url, stand_in):
+        first = await fetch_page(fetcher, base_url + "/page", parse_page, page_cache)
+        second = await fetch_page(fetcher, base_url + "/page", parse_page, page_cache)
+        return first, second, stand_in.requests["/page"]
+
+    first, second, n_requests = run_with_server(test)
+
+    assert first == second
+    assert n_requests == 2
+    assert len(parsed) == 1
+
+def test_failed_piece_stops_its_other_download(tmp_path):
+    os.makedirs(tmp_path / "pdf")
+    os.makedirs(tmp_path / "midi")
+    manifest_path = tmp_path / "manifest.jsonl"
+
+    async def test(fetcher, base_url, stand_in):
+        metadata = {"console": "NES", "game": "Game", "piece": "Piece",
+                    "pdf_url": base_url + "/missing.pdf", "midi_url": base_url + "/slow.mid"}
+
+        with open(manifest_path, "a") as manifest_fp:
+            return await download_piece(fetcher, 0, "Series", metadata, str(tmp_path), {}, manifest_fp)
+
+    assert run_with_server(test) is None
+
+    # The midi download was cancelled before the fetcher closed, without leaving a part file
+    assert os.listdir(tmp_path / "pdf") == []
+    assert os.listdir(tmp_path / "midi") == []
+    with open(manifest_path, "r") as fp:
+        assert [json.loads(line) for line in fp] == []
+
+def file_requests(stand_in, method):
+    return sorted(path for m, path in stand_in.methods if m == method and path.startswith("/sheets/"))
+
+def test_download_corpus_and_resume(tmp_path):
+    out_path, manifest_path = str(tmp_path), str(tmp_path / "manifest.jsonl")
+    stand_in = StandIn()
+
+    async def run_corpus(base_url):
+        stand_in.methods = []
+        return await download_corpus(base_url, out_path, manifest_path)
+
+    async def main():
+        # One server for every run, so the urls in the manifest stay the same
+        runner, base_url = await serve(stand_in)
+        try:
+            pieces = await run_corpus(base_url)
+
+            # Overworld Theme and Overworld: Theme clean to the same file, which is downloaded once
+            assert [(p["id"], p["piece"]) for p in pieces] == [("1", "Overworld Theme"), ("2", "Underground"), ("3", "Overworld Theme")]
+            assert pieces[0]["midi"] == pieces[2]["midi"]
+            assert file_requests(stand_in, "GET") == ["/sheets/overworld.mid", "/sheets/overworld.pdf", "/sheets/underground.mid", "/sheets/underground.pdf"]
+
+            with open(manifest_path, "r") as fp:
+                manifest = [json.loads(line) for line in fp]
+            assert len(manifest) == 4
+
+            for piece in pieces:
+                with open(piece["midi"], "rb") as fp:
+                    assert fp.read() == MIDI_BYTES
+                with open(piece["pdf"], "rb") as fp:
+                    assert fp.read() == PDF_BYTES
+
+            # Files in the manifest are not requested again
+            assert await run_corpus(base_url) == pieces
+            assert file_requests(stand_in, "GET") == []
+            assert file_requests(stand_in, "HEAD") == []
+
+            # Without a manifest, files on disk are checked against the size the server reports
+            os.remove(manifest_path)
+            assert await run_corpus(base_url) == pieces
+            assert file_requests(stand_in, "GET") == []
+            assert len(file_requests(stand_in, "HEAD")) == 4
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())